@@ -1,5 +1,10 @@
 from django.db.models.sql.query import Query
 from django.db.models.sql.compiler import SQLCompiler
+from django.db import transaction
+
+import elasticutils.contrib.django as elasticutils
+
+from gelato.models import esclients, indexing
 
 def get_default_columns(self, with_aliases=False, col_aliases=None,
             start_alias=None, opts=None, as_pairs=False, local_only=False):
@@ -90,3 +95,58 @@ def setup_inherited_models(self):
     self.included_inherited_models = seen
 
 Query.setup_inherited_models = setup_inherited_models
+
+
+# Django doesn't signal commits or rollbacks, so wrap the functions that
+# commit_on_success, commit_manually and friends call and tell the indexing
+# queue about them.  They look these up as module globals, so replacing them
+# here is seen everywhere.
+_commit = transaction.commit
+_rollback = transaction.rollback
+_leave_transaction_management = transaction.leave_transaction_management
+
+
+def commit(using=None):
+    _commit(using=using)
+    indexing.committed(using)
+
+
+def rollback(using=None):
+    _rollback(using=using)
+    indexing.rolled_back(using)
+
+
+def leave_transaction_management(using=None):
+    _leave_transaction_management(using=using)
+    indexing.left_transaction(using)
+
+transaction.commit = commit
+transaction.rollback = rollback
+transaction.leave_transaction_management = leave_transaction_management
+
+
+# SearchMixin.index(bulk=True) queues documents on the esclients bulk pool,
+# so code that finishes a reindex with
+# elasticutils.get_es().flush_bulk(forced=True) has to send those too.
+class _BulkFlushingES(object):
+
+    def __init__(self, es):
+        self.__dict__['_es'] = es
+
+    def __getattr__(self, attr):
+        return getattr(self._es, attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._es, attr, value)
+
+    def flush_bulk(self, forced=False):
+        esclients.flush_bulk()
+        return self._es.flush_bulk(forced=forced)
+
+_get_es = elasticutils.get_es
+
+
+def get_es(*args, **kw):
+    return _BulkFlushingES(_get_es(*args, **kw))
+
+elasticutils.get_es = get_es
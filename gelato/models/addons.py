@@ -8,11 +8,14 @@ from jinja2.filters import do_dictsort
 
 from tower import ugettext_lazy as _
 from gelato.constants import base
+from gelato.constants.applications import APP_IDS
 from gelato.translations.fields import (LinkifiedField, TranslatedField,
                                         PurifiedField)
 from gelato.models.fields import DecimalCharField
 from gelato.models.base import OnChangeMixin, ModelBase
-from gelato.models.versions import VersionBase
+from gelato.models.transforms import cached_transform
+from gelato.models.applications import Application, AppVersion
+from gelato.models.versions import ApplicationsVersions, VersionBase
 from gelato.models.users import UserProfileBase, UserForeignKey
 from gelato.models.utils import sorted_groupby
 
@@ -22,6 +25,8 @@ class AddonBase(OnChangeMixin, ModelBase):
     STATUS_CHOICES = base.STATUS_CHOICES.items()
     LOCALES = [(translation.to_locale(k).replace('_', '-'), v) for k, v in
                do_dictsort(settings.LANGUAGES)]
+    # Bots probe for slugs and guids that don't exist.
+    negative_cache_fields = ('guid', 'slug', 'app_slug')
 
     guid = models.CharField(max_length=255, unique=True, null=True)
     slug = models.CharField(max_length=30, unique=True, null=True)
@@ -188,6 +193,65 @@ class AddonBase(OnChangeMixin, ModelBase):
         super(AddonBase, self).__init__(*args, **kw)
         self._first_category = {}
 
+    @staticmethod
+    def attach_related_versions(addons):
+        """
+        Attach the current, backup and latest versions to ``addons``, with
+        each version's compatibility rows and their min and max AppVersions,
+        in the same few queries however many add-ons there are.
+
+        The latest version is the one with the highest id, found with one
+        grouped query.  Each version gets ``compatible_apps``, a dict of
+        {app: ApplicationsVersions}.
+        """
+        if not addons:
+            return
+        ids = set(a.id for a in addons)
+        # Clear the Meta ordering, or its columns end up in the GROUP BY and
+        # an add-on can come back once per version.
+        latest = dict(VersionBase.objects.no_cache()
+                      .filter(addon__in=ids).order_by().values_list('addon')
+                      .annotate(latest=models.Max('id')))
+        version_ids = set(latest.values())
+        for addon in addons:
+            version_ids.update([addon._current_version_id,
+                                addon._backup_version_id])
+        version_ids.discard(None)
+        versions = dict((v.id, v) for v in
+                        VersionBase.objects.filter(id__in=version_ids))
+
+        apps = (list(ApplicationsVersions.objects
+                     .filter(version__in=versions))
+                if versions else [])
+        appversions = dict((av.id, av) for av in AppVersion.objects.filter(
+            id__in=set(a.min_id for a in apps) | set(a.max_id for a in apps)))
+        applications = dict((a.id, a) for a in Application.objects.all())
+
+        def cache(obj, field, value):
+            # Fill the foreign key's cache without going through __setattr__,
+            # which would treat it as a change.
+            name = obj._meta.get_field(field).get_cache_name()
+            obj.__dict__[name] = value
+
+        by_addon = dict((a.id, a) for a in addons)
+        for version in versions.values():
+            version.compatible_apps = {}
+            if version.addon_id in by_addon:
+                cache(version, 'addon', by_addon[version.addon_id])
+        for row in apps:
+            cache(row, 'version', versions[row.version_id])
+            cache(row, 'application', applications.get(row.application_id))
+            cache(row, 'min', appversions.get(row.min_id))
+            cache(row, 'max', appversions.get(row.max_id))
+            version = versions[row.version_id]
+            version.compatible_apps[APP_IDS.get(row.application_id)] = row
+
+        for addon in addons:
+            cache(addon, '_current_version',
+                  versions.get(addon._current_version_id))
+            cache(addon, '_backup_version',
+                  versions.get(addon._backup_version_id))
+            addon._latest_version = versions.get(latest.get(addon.id))
 
     @property
     def premium(self):
@@ -249,6 +313,8 @@ class Category(ModelBase):
         return urlresolvers.reverse('browse.%s' % type, args=[self.slug])
 
     @staticmethod
+    @cached_transform(attr='all_categories', name='categories',
+                      per_locale=True)
     def transformer(addons):
         qs = (Category.uncached.filter(addons__in=addons)
               .extra(select={'addon_id': 'addons_categories.addon_id'}))
@@ -275,6 +341,11 @@ class AddonCategoryBase(caching.base.CachingMixin, models.Model):
                 '*%s' % self.category.get_url_path(), ]
         return urls
 
+# An add-on's categories change with its AddonCategory rows, and every
+# add-on's cached categories go stale when a category or its name is edited.
+Category.transformer.invalidate_on(AddonCategoryBase, lambda ac: [ac.addon_id])
+Category.transformer.invalidate_on(Category, translated=['name'])
+
 class AddonUser(caching.base.CachingMixin, models.Model):
     addon = models.ForeignKey(AddonBase)
     user = UserForeignKey()
@@ -309,3 +380,50 @@ class AddonDependency(models.Model):
         unique_together = ('addon', 'dependent_addon')
         app_label = 'addons'
 
+
+
+def _prefetch_premium(addons):
+    AddonPremium = models.get_model('addons', 'addonpremium')
+    if AddonPremium is None:
+        return
+    ids = set(a.id for a in addons)
+    premiums = dict((p.addon_id, p)
+                    for p in AddonPremium.objects.filter(addon__in=ids))
+    for addon in addons:
+        addon._premium = premiums.get(addon.id)
+
+
+def _prefetch_authors(addons):
+    ids = set(a.id for a in addons)
+    qs = (AddonUser.objects.filter(addon__in=ids, listed=True)
+          .select_related('user').order_by('addon', 'position'))
+    authors = dict((addon_id, [au.user for au in aus])
+                   for addon_id, aus in sorted_groupby(qs, 'addon_id'))
+    for addon in addons:
+        addon.listed_authors = authors.get(addon.id, [])
+
+
+def _prefetch_dependencies(addons):
+    ids = set(a.id for a in addons)
+    deps = list(AddonDependency.objects.filter(addon__in=ids)
+                .values_list('addon', 'dependent_addon'))
+    dep_ids = set(dep for _, dep in deps)
+    found = (dict((a.id, a) for a in
+                  AddonBase.objects.filter(id__in=dep_ids))
+             if dep_ids else {})
+    by_addon = collections.defaultdict(list)
+    for addon_id, dep in deps:
+        if dep in found:
+            by_addon[addon_id].append(found[dep])
+    for addon in addons:
+        addon.all_dependencies = by_addon.get(addon.id, [])
+
+AddonBase.register_prefetch('premium', _prefetch_premium, attr='_premium',
+                            locale_free=True)
+AddonBase.register_prefetch('authors', _prefetch_authors,
+                            attr='listed_authors')
+AddonBase.register_prefetch('categories', Category.transformer,
+                            attr='all_categories')
+AddonBase.register_prefetch('dependencies', _prefetch_dependencies,
+                            attr='all_dependencies')
+AddonBase.register_prefetch('versions', AddonBase.attach_related_versions)
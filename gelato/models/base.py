@@ -3,34 +3,94 @@ import gelato.models._fixes
 
 import contextlib
 import functools
+import logging
 import threading
 
 from django.conf import settings
-from django.db import models, transaction
-from django.utils import translation
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.db import connections, models, router, transaction
+from django.db.models.sql.datastructures import EmptyResultSet
+from django.dispatch import Signal
+from django.utils.encoding import smart_str
 
 import caching.base
-import elasticutils.contrib.django as elasticutils
 import pyes.exceptions
 import queryset_transform
 
-from gelato.models import search
+from gelato.models import (cachepolicy, cachestats, esclients, identity,
+                           indexing, routers, search)
+
+log = logging.getLogger('z.es')
 
 _locals = threading.local()
-_locals.skip_cache = False
 
-@contextlib.contextmanager
+
 def skip_cache():
     """Within this context, no queries come from cache."""
-    old = getattr(_locals, 'skip_cache', False)
-    _locals.skip_cache = True
+    return cachepolicy.cache_policy(cachepolicy.BYPASS)
+
+
+@contextlib.contextmanager
+def coalesce_updates():
+    """
+    Merge the instance.update() calls made within this context into one
+    UPDATE per row, written when the block exits cleanly.
+
+    Instances see their new values right away, but the database, the cache
+    and other instances of the same row don't until the block is done.  The
+    signals and on_change() callbacks fire once per row, at the end, with the
+    values from before the block as the old ones.  Nothing is written if the
+    block raises.  Nested blocks join the outermost one.
+    """
+    if getattr(_locals, 'coalescing', None) is not None:
+        yield
+        return
+    _locals.coalescing = pending = {}
     try:
         yield
     finally:
-        _locals.skip_cache = old
+        _locals.coalescing = None
+    for row in pending.values():
+        # Put the old values back so the real update sees what changed.
+        row['instance'].__dict__.update(row['original'])
+        row['instance'].update(_signal=row['signal'], **row['kw'])
+
+
+def _coalesce(instance, kw):
+    """Hold ``kw`` for coalesce_updates() if it's active, or return False."""
+    pending = getattr(_locals, 'coalescing', None)
+    if pending is None or instance.pk is None:
+        return False
+    cls = instance.__class__
+    row = pending.setdefault((cls, instance.pk), {
+        'instance': instance, 'kw': {}, 'original': {}, 'signal': False})
+    signal = kw.pop('_signal', True)
+    row['signal'] = row['signal'] or signal
+    translated = [f.name for f in getattr(cls._meta, 'translated_fields', ())]
+    for k, v in kw.items():
+        attname = _attname(cls, k)
+        if (k not in translated and attname not in row['original'] and
+                attname in instance.__dict__):
+            row['original'][attname] = instance.__dict__[attname]
+        setattr(instance, k, v)
+        if row['instance'] is not instance:
+            # Another instance of the row writes the merged values.
+            setattr(row['instance'], k, v)
+        row['kw'][k] = v
+    return True
 
 
 class SearchMixin(object):
+    # Set this to reindex objects automatically after they're saved.  The
+    # model has to implement extract().
+    index_on_change = False
+    # {attname: document field} for attributes that can be sent on their own
+    # in a partial update instead of rebuilding the whole document.
+    # Translated fields can't be listed: the attribute is the Translation id.
+    partial_index_fields = {}
+    # Properties and methods that search results built from the documents
+    # (ES.values_object()) can use.  They may only read indexed fields.
+    source_properties = ()
 
     @classmethod
     def _get_index(cls):
@@ -40,24 +100,86 @@ class SearchMixin(object):
     @classmethod
     def index(cls, document, id=None, bulk=False, force_insert=False):
         """Wrapper around pyes.ES.index."""
-        elasticutils.get_es().index(
-            document, index=cls._get_index(), doc_type=cls._meta.db_table,
-            id=id, bulk=bulk, force_insert=force_insert)
+        with esclients.get_es('bulk' if bulk else 'index') as es:
+            es.index(document, index=cls._get_index(),
+                     doc_type=cls._meta.db_table, id=id, bulk=bulk,
+                     force_insert=force_insert)
 
     @classmethod
     def unindex(cls, id):
-        es = elasticutils.get_es()
-        try:
-            es.delete(cls._get_index(), cls._meta.db_table, id)
-        except pyes.exceptions.NotFoundException:
-            # Item wasn't found, whatevs.
-            pass
+        with esclients.get_es('index') as es:
+            try:
+                es.delete(cls._get_index(), cls._meta.db_table, id)
+            except pyes.exceptions.NotFoundException:
+                # Item wasn't found, whatevs.
+                pass
+
+    @classmethod
+    def index_ids(cls, ids):
+        """Index the objects with these ids in one bulk request."""
+        with esclients.get_es('bulk') as es:
+            for obj in cls.uncached.filter(pk__in=ids):
+                es.index(obj.extract(), index=cls._get_index(),
+                         doc_type=cls._meta.db_table, id=obj.pk, bulk=True)
+            es.flush_bulk(forced=True)
+
+    @classmethod
+    def flush_bulk(cls):
+        """Send the documents queued by index(bulk=True)."""
+        esclients.flush_bulk('bulk')
+
+    @classmethod
+    def partial_index(cls, docs):
+        """
+        Send partial updates from a {pk: {field: value}} mapping.
+
+        Returns the pks of documents that couldn't be updated, like the ones
+        that aren't in the index yet, so they can be indexed in full.
+        """
+        missing = []
+        with esclients.get_es('index') as es:
+            for pk, doc in docs.items():
+                fields = sorted(doc)
+                script = '; '.join('ctx._source.%s = p%s' % (f, i)
+                                   for i, f in enumerate(fields))
+                params = dict(('p%s' % i, doc[f])
+                              for i, f in enumerate(fields))
+                path = '/%s/%s/%s/_update' % (cls._get_index(),
+                                              cls._meta.db_table, pk)
+                try:
+                    es._send_request('POST', path,
+                                     {'script': script, 'params': params})
+                except Exception, e:
+                    # A document that isn't there yet is a 404.
+                    if getattr(e, 'status', None) != 404:
+                        log.warning('Partial update of %s %s failed: %s'
+                                    % (cls.__name__, pk, e))
+                    missing.append(pk)
+        return missing
+
+    def extract(self):
+        """Return the document to store in ES for this object."""
+        raise NotImplementedError()
 
     @classmethod
     def search(cls):
         return search.ES(cls, cls._get_index())
 
 
+def _check_partial_index_fields(sender, **kw):
+    mapping = getattr(sender, 'partial_index_fields', None)
+    if not mapping:
+        return
+    for field in getattr(sender._meta, 'translated_fields', ()):
+        if field.name in mapping or field.attname in mapping:
+            raise ImproperlyConfigured(
+                '%s.partial_index_fields lists the translated field %s.'
+                % (sender.__name__, field.name))
+
+models.signals.class_prepared.connect(
+    _check_partial_index_fields, dispatch_uid='base.partial_index_fields')
+
+
 class _NoChangeInstance(object):
     """A proxy for object instances to make safe operations within an
     OnChangeMixin.on_change() callback.
@@ -90,6 +212,79 @@ class _NoChangeInstance(object):
 
 _on_change_callbacks = {}
 
+# {model: {name: loader}} for TransformQuerySet.prefetch().
+_prefetchers = {}
+
+# Sent once for each chunk of rows written by bulk_update(signal=True).
+post_bulk_update = Signal(providing_args=['instances', 'fields'])
+
+
+def _attnames(cls):
+    """The attnames of the model's concrete fields, cached on its _meta."""
+    try:
+        return cls._meta._tracked_attnames
+    except AttributeError:
+        names = frozenset(f.attname for f in cls._meta.fields)
+        cls._meta._tracked_attnames = names
+        return names
+
+
+def _prefetcher(model, name):
+    for cls in model.__mro__:
+        if name in _prefetchers.get(cls, {}):
+            return _prefetchers[cls][name]
+    raise ValueError('%s has no prefetch called %r.' % (model.__name__, name))
+
+
+def _transform_key(fn):
+    """A name for the transform ``fn`` that's the same in every process."""
+    key = getattr(fn, 'transform_key', None)
+    if key is None:
+        code = getattr(fn, 'func_code', None)
+        key = '%s.%s:%s' % (fn.__module__, fn.__name__,
+                            code.co_firstlineno if code else '')
+    return key
+
+
+def _run_transforms(fns, objs):
+    """
+    Run each transform on the objects it hasn't run on yet.  Instances from
+    the identity map can come from querysets with other transforms.
+    """
+    for fn in fns:
+        key = _transform_key(fn)
+        todo, seen = [], set()
+        for obj in objs:
+            done = getattr(obj, '__dict__', {}).get('_transformed', ())
+            if key not in done and id(obj) not in seen:
+                seen.add(id(obj))
+                todo.append(obj)
+        if not todo:
+            continue
+        fn(todo)
+        for obj in todo:
+            if hasattr(obj, '__dict__'):
+                obj.__dict__.setdefault('_transformed', set()).add(key)
+
+
+def _attname(cls, name):
+    try:
+        return cls._meta.get_field(name).attname
+    except models.FieldDoesNotExist:
+        return name
+
+
+def _to_python(field, value):
+    """``value`` as the database would give it back for ``field``."""
+    if field.rel:
+        value = getattr(value, 'pk', value)
+        field = field.rel.get_related_field()
+    try:
+        return field.to_python(value)
+    except ValidationError:
+        return value
+
+
 class OnChangeMixin(object):
     """Mixin for a Model that allows you to observe attribute changes.
 
@@ -102,14 +297,58 @@ class OnChangeMixin(object):
 
         YourModel.on_change(callback)
 
+    Only the fields that are assigned after the instance is created get their
+    original values remembered, so loading instances doesn't cost a copy of
+    their attributes.  Set
+    ``save_dirty_only = True`` on the model to have save() UPDATE just the
+    columns that changed on rows loaded from the database.  New instances
+    are always INSERTed, even with their pk set.
+
     """
+    save_dirty_only = False
 
     def __init__(self, *args, **kw):
         super(OnChangeMixin, self).__init__(*args, **kw)
-        self._initial_attr = dict(self.__dict__)
+        self._start_tracking()
+
+    def _start_tracking(self, dirty=None):
+        # {attname: value when loaded or last saved} for assigned fields.
+        dirty = dict(dirty or {})
+        self.__dict__['_dirty_attr'] = dirty
+        self.__dict__['_trackers'] = [dirty]
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # copy.copy() hands us the original's trackers, and instances pickled
+        # before changes were tracked on assignment don't have any.
+        self._start_tracking(state.get('_dirty_attr'))
+
+    def __setattr__(self, attr, val):
+        # Copy-on-first-write: while changes are tracked, remember a field's
+        # value the first time it's assigned.  Tracking starts after
+        # __init__, so loading an instance skips all of this.
+        trackers = self.__dict__.get('_trackers')
+        if (trackers and attr in self.__dict__
+                and attr in _attnames(self.__class__)):
+            old = self.__dict__[attr]
+            for changed in trackers:
+                if attr not in changed:
+                    changed[attr] = old
+        super(OnChangeMixin, self).__setattr__(attr, val)
+
+    @contextlib.contextmanager
+    def _track_changes(self):
+        """Collect {attname: old value} for fields assigned in the block."""
+        changed = {}
+        trackers = self.__dict__.setdefault('_trackers', [])
+        trackers.append(changed)
+        try:
+            yield changed
+        finally:
+            trackers.pop()
 
     @classmethod
-    def on_change(cls, callback):
+    def on_change(cls, callback, fields=None, batch=False):
         """Register a function to call on save or update to respond to changes.
 
         For example::
@@ -121,21 +360,80 @@ class OnChangeMixin(object):
                     new_instance.save(_signal=False)
             TheModel.on_change(watch_status)
 
+        Pass ``fields`` to only have the callback called when one of those
+        fields changed::
+
+            TheModel.on_change(watch_status, fields=['status'])
+
+        With ``batch=True`` the callback is called once with all the changes
+        made by a ``QuerySet.update_notify()``, as a list of
+        ``(pk, old_attr, new_attr)`` tuples, instead of once per instance::
+
+            def watch_statuses(changes=[], sender=None, **kw):
+                for pk, old_attr, new_attr in changes:
+                    # ...
+            TheModel.on_change(watch_statuses, fields=['status'], batch=True)
+
+        Single saves and updates send batch callbacks a list of one change.
+
         .. note::
 
             Any call to instance.save() or instance.update() within a callback
             will not trigger any change handlers.
 
         """
-        _on_change_callbacks.setdefault(cls, []).append(callback)
+        if fields is not None:
+            # Changes are reported by attname, and translations by name.
+            fields = frozenset(fields) | frozenset(_attname(cls, f)
+                                                   for f in fields)
+        _on_change_callbacks.setdefault(cls, []).append(
+            (callback, fields, batch))
         return callback
 
-    def _send_changes(self, old_attr, new_attr_kw):
+    @classmethod
+    def _watching(cls, changed):
+        """
+        The (callback, batch) pairs that want to hear about the ``changed``
+        fields.
+        """
+        changed = frozenset(changed)
+        return [(cb, batch)
+                for cb, fields, batch in _on_change_callbacks.get(cls, ())
+                if fields is None or fields & changed]
+
+    def _changed_fields(self):
+        """Names of the fields that differ from their saved values."""
+        changed = [k for k, v in self._dirty_attr.items()
+                   if v != self.__dict__[k]]
+        # Translations can change without their id changing.
+        changed.extend(self.__dict__.pop('_changed_translations', ()))
+        return changed
+
+    def _save_dirty(self):
+        """UPDATE only the changed columns, with the signals save() sends."""
+        cls = self.__class__
+        models.signals.pre_save.send(sender=cls, instance=self, raw=False)
+        for f in self._meta.fields:
+            if getattr(f, 'auto_now', False):
+                f.pre_save(self, False)
+        changed = set(self._changed_fields())
+        values = dict((f.name, self.__dict__[f.attname])
+                      for f in self._meta.fields if f.attname in changed)
+        if values:
+            cls.objects.filter(pk=self.pk).update(**values)
+        models.signals.post_save.send(sender=cls, instance=self,
+                                      created=False, raw=False)
+
+    def _send_changes(self, old_attr, new_attr_kw, callbacks):
         new_attr = old_attr.copy()
         new_attr.update(new_attr_kw)
-        for cb in _on_change_callbacks[self.__class__]:
-            cb(old_attr=old_attr, new_attr=new_attr,
-               instance=_NoChangeInstance(self), sender=self.__class__)
+        for cb, batch in callbacks:
+            if batch:
+                cb(changes=[(self.pk, old_attr, new_attr)],
+                   sender=self.__class__)
+            else:
+                cb(old_attr=old_attr, new_attr=new_attr,
+                   instance=_NoChangeInstance(self), sender=self.__class__)
 
     def save(self, *args, **kw):
         """
@@ -144,9 +442,23 @@ class OnChangeMixin(object):
         If _signal=False is in `kw` the on_change() callbacks won't be called.
         """
         signal = kw.pop('_signal', True)
-        result = super(OnChangeMixin, self).save(*args, **kw)
-        if signal and self.__class__ in _on_change_callbacks:
-            self._send_changes(self._initial_attr, dict(self.__dict__))
+        dirty = self._dirty_attr
+        adding = self._state.adding
+        if (self.save_dirty_only and not adding and self.pk is not None
+                and not args and not kw
+                and '_changed_translations' not in self.__dict__):
+            result = self._save_dirty()
+        else:
+            result = super(OnChangeMixin, self).save(*args, **kw)
+        changed = self._changed_fields()
+        # New rows aren't in the index, so they're always indexed in full.
+        indexing.queue(self, None if adding else changed)
+        callbacks = signal and self._watching(changed)
+        if callbacks:
+            old_attr = dict(self.__dict__)
+            old_attr.update(dirty)
+            self._send_changes(old_attr, dict(self.__dict__), callbacks)
+        dirty.clear()
         return result
 
     def update(self, **kw):
@@ -155,15 +467,64 @@ class OnChangeMixin(object):
 
         If _signal=False is in ``kw`` the post_save signal won't be sent.
         """
+        if _coalesce(self, kw):
+            return
         signal = kw.pop('_signal', True)
-        old_attr = dict(self.__dict__)
-        result = super(OnChangeMixin, self).update(**kw)
-        if signal and self.__class__ in _on_change_callbacks:
-            self._send_changes(old_attr, kw)
+        # Fields that were already dirty have their saved values in here.
+        saved = dict(self._dirty_attr)
+        with self._track_changes() as changed:
+            result = super(OnChangeMixin, self).update(_signal=signal, **kw)
+        # The translations are saved by pre_save, so a later save() doesn't
+        # have to report them again.
+        translations = (self.__dict__.pop('_changed_translations', ())
+                        if signal else ())
+        if not (signal and self.__class__ in _on_change_callbacks):
+            return result
+        old = dict((k, saved.get(k, v)) for k, v in changed.items())
+        diff = [k for k, v in old.items() if v != self.__dict__[k]]
+        diff.extend(translations)
+        callbacks = self._watching(diff)
+        if callbacks:
+            old_attr = dict(self.__dict__)
+            old_attr.update(old)
+            new_attr = dict((k, self.__dict__[k]) for k in old)
+            new_attr.update(kw)
+            self._send_changes(old_attr, new_attr, callbacks)
         return result
 
 
 class TransformQuerySet(queryset_transform.TransformQuerySet):
+    # Whether transforms marked after_cache are left for the caller, which
+    # runs them on the objects coming out of the cache.
+    defer_after_cache = False
+
+    def _transforms(self, after_cache):
+        return [fn for fn in self._transform_fns
+                if getattr(fn, 'after_cache', False) == after_cache]
+
+    def iterator(self):
+        # Route the query once, so the read is counted where it goes.
+        qs = self if self._db else self.using(self.db)
+        routers.read(qs.model, qs.db)
+        base = super(queryset_transform.TransformQuerySet, qs).iterator()
+        if self.defer_after_cache:
+            fns = self._transforms(after_cache=False)
+        else:
+            fns = self._transform_fns
+        if not fns:
+            return base
+        results = list(base)
+        _run_transforms(fns, results)
+        return iter(results)
+
+    def update(self, **kw):
+        rows = super(TransformQuerySet, self).update(**kw)
+        routers.wrote()
+        # Lookups that missed might find the rows with their new values.
+        _forget_values(self.model, dict(
+            (k, v) for k, v in kw.items()
+            if not isinstance(v, models.expressions.ExpressionNode)))
+        return rows
 
     def pop_transforms(self):
         qs = self._clone()
@@ -182,37 +543,433 @@ class TransformQuerySet(queryset_transform.TransformQuerySet):
                 .transform(transformer.get_trans))
 
     def transform(self, fn):
+        if getattr(fn, 'follows_cache_policy', False):
+            return super(TransformQuerySet, self).transform(fn)
+
         @functools.wraps(fn)
         def wrapper(*args, **kw):
             with skip_cache():
                 return fn(*args, **kw)
+        wrapper.transform_key = _transform_key(fn)
         return super(TransformQuerySet, self).transform(wrapper)
 
+    def prefetch(self, *names):
+        """
+        Load related objects for the whole batch of results with the loaders
+        the model registered under ``names``.  See
+        ModelBase.register_prefetch().
+        """
+        qs = self
+        for name in sorted(set(names), key=names.index):
+            qs = qs.transform(_prefetcher(self.model, name))
+        return qs
+
+    def update_notify(self, **kw):
+        """
+        Like update(), but the model's on_change() callbacks hear about it.
+
+        The old values of the updated columns are fetched in one query before
+        a single UPDATE.  Batch callbacks get every changed row in one call.
+        Other callbacks are called per row with an instance, so if there are
+        any the full rows are loaded instead of just the updated columns.
+        """
+        model = self.model
+        fields = dict((model._meta.get_field(k).attname,
+                       model._meta.get_field(k)) for k in kw)
+        watching = (issubclass(model, OnChangeMixin) and
+                    model._watching(fields))
+        if not watching:
+            return self.update(**kw)
+
+        qs = self.no_transforms()
+        if hasattr(qs, 'no_cache'):
+            qs = qs.no_cache()
+        instances = {}
+        if any(not batch for cb, batch in watching):
+            instances = dict((obj.pk, obj) for obj in qs)
+            old = dict((pk, dict((k, obj.__dict__[k]) for k in fields))
+                       for pk, obj in instances.items())
+        else:
+            old = dict((row[0], dict(zip(fields, row[1:])))
+                       for row in qs.values_list('pk', *fields))
+        if not old:
+            return 0
+
+        # The plain update(), since the misses are forgotten below with the
+        # values F() expressions came to.
+        count = models.query.QuerySet.update(qs.filter(pk__in=old.keys()),
+                                             **kw)
+        routers.wrote()
+
+        if any(isinstance(v, models.expressions.ExpressionNode)
+               for v in kw.values()):
+            # F() expressions are computed by the database.
+            new = dict((row[0], dict(zip(fields, row[1:])))
+                       for row in qs.filter(pk__in=old.keys())
+                                    .values_list('pk', *fields))
+        else:
+            # Compare what the database will hand back, so '4' isn't a
+            # change from 4.
+            values = dict((f.attname, _to_python(f, kw[f.name]))
+                          for f in fields.values())
+            new = dict((pk, values) for pk in old)
+
+        # Forget everything instance.update() would have.
+        if hasattr(model.objects, 'invalidate'):
+            model.objects.invalidate(*[instances.get(pk) or model(pk=pk)
+                                       for pk in old])
+            invalidate_raw(model)
+
+        # {(callback, batch): [(pk, old_attr, new_attr), ...]}
+        heard, changed_rows = {}, {}
+        for pk, old_attr in old.items():
+            changed = [k for k, v in old_attr.items() if new[pk][k] != v]
+            if not changed:
+                continue
+            changed_rows[pk] = new[pk]
+            for watcher in model._watching(changed):
+                heard.setdefault(watcher, []).append(
+                    (pk, old_attr, new[pk]))
+        _forget_values(model, *changed_rows.values())
+        indexing.queue_changes(model, changed_rows)
+
+        for cb, batch in watching:
+            changes = heard.get((cb, batch))
+            if not changes:
+                continue
+            if batch:
+                cb(changes=changes, sender=model)
+                continue
+            for pk, old_attr, new_attr in changes:
+                obj = instances[pk]
+                old_full = dict(obj.__dict__, **old_attr)
+                obj.__dict__.update(new_attr)
+                obj._send_changes(old_full, new_attr, [(cb, False)])
+        return count
+
 
 class RawQuerySet(models.query.RawQuerySet):
-    """A RawQuerySet with __len__."""
+    """
+    A RawQuerySet with __len__ that can also be streamed.
+
+    Iterating keeps the objects around like a QuerySet does.  Use iterator()
+    or chunks() to go through big results without holding all of them.
+    """
 
     def __init__(self, *args, **kw):
         super(RawQuerySet, self).__init__(*args, **kw)
         self._result_cache = None
+        self._count = None
 
     def __iter__(self):
         if self._result_cache is None:
-            self._result_cache = list(super(RawQuerySet, self).__iter__())
+            self._result_cache = list(self.iterator())
         return iter(self._result_cache)
 
+    def iterator(self):
+        """Yield the objects one at a time without keeping them."""
+        return super(RawQuerySet, self).__iter__()
+
+    def chunks(self, size=1000):
+        """Yield lists of up to ``size`` objects without keeping them."""
+        chunk = []
+        for obj in self.iterator():
+            chunk.append(obj)
+            if len(chunk) == size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def count(self):
+        """Run a COUNT(*) over the query instead of fetching the rows."""
+        if self._result_cache is not None:
+            return len(self._result_cache)
+        cursor = connections[self.db].cursor()
+        cursor.execute('SELECT COUNT(*) FROM (%s) AS raw_count'
+                       % self.raw_query, self.params)
+        return cursor.fetchone()[0]
+
     def __len__(self):
+        if self._result_cache is not None:
+            return len(self._result_cache)
+        if self._count is None:
+            self._count = self.count()
+        return self._count
+
+
+def _raw_key(model):
+    """Raw queries on ``model`` are on this key's flush list."""
+    return 'raw:%s' % model._meta.db_table
+
+
+def invalidate_raw(model):
+    """Flush the cached raw queries on ``model``."""
+    caching.base.invalidator.invalidate_keys([_raw_key(model)])
+
+
+class _RawCacheMachine(caching.base.CacheMachine):
+
+    def __init__(self, model, *args, **kw):
+        self.model = model
+        super(_RawCacheMachine, self).__init__(*args, **kw)
+
+    def cache_objects(self, objects):
+        super(_RawCacheMachine, self).cache_objects(objects)
+        # The rows' flush lists cover changes to them, but not new rows that
+        # would match, so changes anywhere in the table flush the query too.
+        flush = caching.base.flush_key(_raw_key(self.model))
+        caching.base.invalidator.add_to_flush_list(
+            {flush: [self.query_key()]})
+
+
+class CachingRawQuerySet(RawQuerySet):
+    """
+    A RawQuerySet whose results are cached until any row of the model is
+    saved or deleted.
+    """
+
+    def __init__(self, *args, **kw):
+        self.timeout = kw.pop('timeout', None)
+        super(CachingRawQuerySet, self).__init__(*args, **kw)
+
+    def iterator(self):
+        uncached = super(CachingRawQuerySet, self).iterator
+        policy = cachepolicy.get_policy()
+        cachepolicy.count(policy)
+        if policy == cachepolicy.BYPASS:
+            return uncached()
+        query_string = '%s:%s %r' % (self.db, self.raw_query, self.params)
+        machine = _RawCacheMachine(self.model, query_string, uncached,
+                                   timeout=self.timeout)
+        if policy == cachepolicy.REFRESH:
+            caching.base.cache.delete(machine.query_key())
+        return iter(machine)
+
+    def __len__(self):
+        # Counting would miss the cache, so use the (cached) results.
         return len(list(self.__iter__()))
 
 
-class CachingRawQuerySet(RawQuerySet, caching.base.CachingRawQuerySet):
-    """A RawQuerySet with __len__ and caching."""
+def _flush_raw(sender, **kw):
+    if issubclass(sender, caching.base.CachingMixin):
+        invalidate_raw(sender)
+
+models.signals.post_save.connect(_flush_raw, dispatch_uid='base.flush_raw')
+models.signals.post_delete.connect(_flush_raw, dispatch_uid='base.flush_raw')
 
 # Make TransformQuerySet one of CachingQuerySet's parents so that we can do
 # transforms on objects and then get them cached.
 CachingQuerySet = caching.base.CachingQuerySet
 CachingQuerySet.__bases__ = (TransformQuerySet,) + CachingQuerySet.__bases__
 
+
+class _SharedCacheMachine(caching.base.CacheMachine):
+    """A CacheMachine whose results are shared by every locale."""
+
+    def query_key(self):
+        return caching.base.make_key('qs:%s' % self.query_string,
+                                     with_locale=False)
+
+
+class PolicyQuerySet(CachingQuerySet):
+    """
+    A CachingQuerySet that follows the cache policy in effect and shares
+    instances through the identity map.
+
+    Transforms marked ``after_cache`` (like the translations) run on the
+    objects coming out of the cache instead of going in.  If that leaves
+    nothing that depends on the locale, every locale shares one cached copy
+    of the results.
+    """
+    # Whether to share instances through the identity map when it's on.
+    use_identity_map = True
+    defer_after_cache = True
+    # Set on the querysets managers hand out, and lost on filtering, so a
+    # get() by pk on one can be answered from the identity map.
+    _pristine = False
+
+    def _machine(self, query_string, iterator=None):
+        if [fn for fn in self._transforms(after_cache=False)
+                if not getattr(fn, 'locale_free', False)]:
+            # Those transforms might attach things in the current locale.
+            cls = caching.base.CacheMachine
+        else:
+            cls = _SharedCacheMachine
+        return cls(query_string, iterator, timeout=self.timeout)
+
+    def _cached(self):
+        # What CachingQuerySet.iterator does, with our own CacheMachine.
+        iterator = super(CachingQuerySet, self).iterator
+        if self.timeout == getattr(caching.base, 'NO_CACHE', -1):
+            return iterator()
+        try:
+            query_string = self.query_key()
+        except EmptyResultSet:
+            return iterator()
+        if getattr(caching.base, 'FETCH_BY_ID', False):
+            iterator = self.fetch_by_id
+        return iter(self._machine(query_string, iterator))
+
+    def fetch_missed(self, pks):
+        others = super(PolicyQuerySet, self).fetch_missed(pks)
+        # The objects go in the cache by id, so leave the after_cache
+        # transforms for our caller like iterator() does.
+        others._transform_fns = self._transforms(after_cache=False)
+        return others
+
+    def iterator(self):
+        policy = cachepolicy.get_policy()
+        cachepolicy.count(policy)
+        if policy == cachepolicy.BYPASS:
+            # Skip the cache; transforms still run.
+            objs = super(CachingQuerySet, self).iterator()
+        else:
+            if policy == cachepolicy.REFRESH:
+                try:
+                    query_string = self.query_key()
+                except EmptyResultSet:
+                    pass
+                else:
+                    key = self._machine(query_string).query_key()
+                    caching.base.cache.delete(key)
+            objs = self._cached()
+        objs = cachestats.observe(self, objs, policy)
+        if self._shares_instances(policy):
+            # Objects from the cache become the instances we already have,
+            # which might not have been through our transforms.  This is
+            # done after the cache so live instances never go in it.
+            objs = list(identity.merge(objs))
+            _run_transforms(self._transforms(after_cache=False), objs)
+        after = self._transforms(after_cache=True)
+        if after:
+            # Everything has to be out of the cache machine, and so cached,
+            # before these touch the objects.
+            objs = list(objs)
+            for fn in after:
+                fn(objs)
+            objs = iter(objs)
+        return objs
+
+    def _shares_instances(self, policy):
+        # Rows with extra columns or aggregates carry more than the row, and
+        # a join can return a row more than once, so they keep their own
+        # objects.
+        return (self.use_identity_map and identity.active() and
+                policy == cachepolicy.READ_THROUGH and
+                not self.query.extra_select and not self.query.aggregates)
+
+    def count(self):
+        policy = cachepolicy.get_policy()
+        if (policy == cachepolicy.BYPASS or
+                self.timeout == getattr(caching.base, 'NO_CACHE', -1)):
+            return super(CachingQuerySet, self).count()
+        try:
+            query_key = self.query_key()
+        except EmptyResultSet:
+            return super(CachingQuerySet, self).count()
+        if policy == cachepolicy.REFRESH:
+            # Drop the count cached_with() stored, so it's counted and
+            # stored again.
+            key = 'count:%s:%s' % (smart_str(query_key), smart_str(query_key))
+            caching.base.cache.delete(caching.base._function_cache_key(key))
+        return super(PolicyQuerySet, self).count()
+
+    def using(self, alias):
+        qs = super(PolicyQuerySet, self).using(alias)
+        # Related object descriptors go through using() before get().
+        qs._pristine = self._pristine
+        return qs
+
+    def _single_lookup(self, args, kw):
+        """
+        The (field name, value) of a get() on nothing but one field, if the
+        identity map and negative cache can answer it.
+        """
+        if (not self._pristine or args or len(kw) != 1 or
+                cachepolicy.get_policy() != cachepolicy.READ_THROUGH):
+            return None
+        (lookup, value), = kw.items()
+        if lookup.endswith('__exact'):
+            lookup = lookup[:-len('__exact')]
+        if lookup == 'pk':
+            lookup = self.model._meta.pk.name
+        return lookup if '__' not in lookup else None, value
+
+    def get(self, *args, **kw):
+        field, value = self._single_lookup(args, kw) or (None, None)
+        pk = self.model._meta.pk
+        if field == pk.name and identity.active():
+            try:
+                obj = identity.get(self.model, pk.to_python(value))
+            except (TypeError, ValueError, ValidationError):
+                obj = None
+            if obj is not None:
+                return obj
+
+        if field not in getattr(self.model, 'negative_cache_fields', ()):
+            return super(PolicyQuerySet, self).get(*args, **kw)
+        key = _miss_key(self.model, field, value)
+        if caching.base.cache.get(key):
+            cachestats.count(self.model, 'negative_hit')
+            raise self.model.DoesNotExist(
+                '%s matching query does not exist.'
+                % self.model._meta.object_name)
+        # Route the read once, so we know where the miss came from.
+        qs = self if self._db else self.using(self.db)
+        try:
+            return super(PolicyQuerySet, qs).get(*args, **kw)
+        except self.model.DoesNotExist:
+            if self._missing_on_master(qs.db, args, kw):
+                timeout = getattr(settings, 'NEGATIVE_CACHE_TIMEOUT', 60)
+                caching.base.cache.set(key, True, timeout)
+            raise
+
+    def _missing_on_master(self, alias, args, kw):
+        """
+        Whether a get() that missed on ``alias`` is sure to miss everywhere,
+        so the miss can be cached for every process.
+        """
+        master = router.db_for_write(self.model)
+        if transaction.is_managed(using=master):
+            # What this transaction sees may not be what the others do.
+            return False
+        if alias == master:
+            return True
+        # A replica might be behind.
+        return not self.using(master).filter(*args, **kw).exists()
+
+
+def _miss_key(model, field, value):
+    if isinstance(value, basestring):
+        # Match the case-insensitive collation of MySQL.
+        value = value.lower()
+    return caching.base.make_key(
+        u'miss:%s:%s:%s' % (model._meta.db_table, field, value),
+        with_locale=False)
+
+
+def _forget_values(model, *rows):
+    """
+    Rows now have these {field: value}s, so lookups that missed them might
+    find them now.
+    """
+    keys = set(_miss_key(model, f, values[f]) for values in rows
+               for f in getattr(model, 'negative_cache_fields', ())
+               if f in values)
+    if keys:
+        caching.base.cache.delete_many(list(keys))
+
+
+def _forget_misses(sender, instance, **kw):
+    """A row was saved, so lookups that missed it might find it now."""
+    fields = getattr(sender, 'negative_cache_fields', ())
+    _forget_values(sender, dict((f, getattr(instance, f)) for f in fields))
+
+models.signals.post_save.connect(_forget_misses,
+                                 dispatch_uid='base.forget_misses')
+
+
 class UncachedManagerBase(models.Manager):
 
     def get_query_set(self):
@@ -221,17 +978,92 @@ class UncachedManagerBase(models.Manager):
 
     def _with_translations(self, qs):
         from gelato.translations import transformer
-        # Since we're attaching translations to the object, we need to stick
-        # the locale in the query so objects aren't shared across locales.
+        # get_trans runs after the cache, so the cached objects don't have
+        # translations and can be shared across locales.
         if hasattr(self.model._meta, 'translated_fields'):
-            lang = translation.get_language()
             qs = qs.transform(transformer.get_trans)
-            qs = qs.extra(where=['"%s"="%s"' % (lang, lang)])
         return qs
 
     def transform(self, fn):
         return self.all().transform(fn)
 
+    def prefetch(self, *names):
+        return self.all().prefetch(*names)
+
+    def update_notify(self, **kw):
+        return self.all().update_notify(**kw)
+
+    def bulk_update(self, updates, chunk_size=500, signal=False):
+        """
+        UPDATE many rows, each with its own values, in a few queries.
+
+        ``updates`` is a list of ``(instance, {field: value})`` pairs.  Rows
+        changing the same fields are written ``chunk_size`` at a time with one
+        ``UPDATE ... SET col = CASE pk WHEN ... END`` per chunk, and the
+        instances get the new values too.  F() expressions aren't supported.
+
+        Per-row signals aren't sent.  Instead the cache is invalidated once per
+        chunk and, if ``signal`` is True, ``post_bulk_update`` is sent with the
+        chunk's instances.
+        """
+        model, meta = self.model, self.model._meta
+        using = router.db_for_write(model)
+        connection = connections[using]
+        qn = connection.ops.quote_name
+
+        groups = {}
+        for obj, kw in updates:
+            if kw:
+                groups.setdefault(tuple(sorted(kw)), []).append((obj, kw))
+
+        count = 0
+        for names, rows in groups.items():
+            fields = [meta.get_field(name) for name in names]
+            for start in range(0, len(rows), chunk_size):
+                chunk = rows[start:start + chunk_size]
+                pks = [obj.pk for obj, kw in chunk]
+                sets, params, changes = [], [], {}
+                for f in fields:
+                    cases = []
+                    for obj, kw in chunk:
+                        value = kw[f.name]
+                        if f.rel:
+                            value = getattr(value, 'pk', value)
+                        changes.setdefault(obj.pk, {})[f.attname] = value
+                        cases.append('WHEN %s THEN %s')
+                        params.extend([obj.pk, f.get_db_prep_save(
+                            value, connection=connection)])
+                    sets.append('%s = CASE %s %s END' % (
+                        qn(f.column), qn(meta.pk.column), ' '.join(cases)))
+                params.extend(pks)
+                sql = 'UPDATE %s SET %s WHERE %s IN (%s)' % (
+                    qn(meta.db_table), ', '.join(sets), qn(meta.pk.column),
+                    ', '.join(['%s'] * len(pks)))
+                cursor = connection.cursor()
+                cursor.execute(sql, params)
+                count += cursor.rowcount
+                transaction.commit_unless_managed(using=using)
+                routers.wrote()
+
+                instances = []
+                for obj, kw in chunk:
+                    for k, v in kw.items():
+                        setattr(obj, k, v)
+                    dirty = obj.__dict__.get('_dirty_attr')
+                    if dirty:
+                        for f in fields:
+                            dirty.pop(f.attname, None)
+                    instances.append(obj)
+                if hasattr(model.objects, 'invalidate'):
+                    model.objects.invalidate(*instances)
+                    invalidate_raw(model)
+                _forget_values(model, *changes.values())
+                indexing.queue_changes(model, changes)
+                if signal:
+                    post_bulk_update.send(sender=model, instances=instances,
+                                          fields=list(names))
+        return count
+
     def raw(self, raw_query, params=None, *args, **kwargs):
         return RawQuerySet(raw_query, self.model, params=params,
                            using=self._db, *args, **kwargs)
@@ -259,17 +1091,27 @@ class ManagerBase(caching.base.CachingManager, UncachedManagerBase):
 
     If a model has translated fields, they'll be attached through a transform
     function.
+
+    Querysets follow the cachepolicy in effect when they're evaluated.
     """
 
     def get_query_set(self):
-        qs = super(ManagerBase, self).get_query_set()
-        if getattr(_locals, 'skip_cache', False):
-            qs = qs.no_cache()
-        return self._with_translations(qs)
+        qs = self._with_translations(PolicyQuerySet(self.model,
+                                                    using=self._db))
+        qs._pristine = True
+        return qs
 
-    #def raw(self, raw_query, params=None, *args, **kwargs):
-    #    return CachingRawQuerySet(raw_query, self.model, params=params,
-    #                              using=self._db, *args, **kwargs)
+    def raw(self, raw_query, params=None, cache=False, *args, **kwargs):
+        """
+        Run a raw query.  Pass ``cache=True`` to cache the results, which are
+        flushed whenever a row of this model is saved or deleted.
+        """
+        if not cache:
+            # Skip CachingManager.raw, which always caches.
+            return UncachedManagerBase.raw(self, raw_query, params, *args,
+                                           **kwargs)
+        return CachingRawQuerySet(raw_query, self.model, params=params,
+                                  using=self._db, *args, **kwargs)
 
 
 class ModelBase(SearchMixin, caching.base.CachingMixin, models.Model):
@@ -286,6 +1128,14 @@ class ModelBase(SearchMixin, caching.base.CachingMixin, models.Model):
     objects = ManagerBase()
     uncached = UncachedManagerBase()
 
+    # Fields whose get() misses, like objects.get(slug=slug) raising
+    # DoesNotExist, are cached for settings.NEGATIVE_CACHE_TIMEOUT seconds.
+    # Misses from a replica are checked on the master first, and misses in
+    # a managed transaction aren't cached.
+    # Writing a matching value through save(), update(), QuerySet.update(),
+    # update_notify() or bulk_update() forgets the miss.
+    negative_cache_fields = ()
+
     class Meta:
         abstract = True
         get_latest_by = 'created'
@@ -293,26 +1143,70 @@ class ModelBase(SearchMixin, caching.base.CachingMixin, models.Model):
     def get_absolute_url(self, *args, **kwargs):
         return self.get_url_path(*args, **kwargs)
 
+    @classmethod
+    def register_prefetch(cls, name, loader, attr=None, locale_free=False):
+        """Register a batch loader that querysets can ask for by name.
+
+        ``loader`` is called with a list of objects and sets what it loads on
+        each of them, with one query for the whole list::
+
+            def load_premium(addons):
+                ...
+                for addon in addons:
+                    addon._premium = premiums.get(addon.id)
+
+            Addon.register_prefetch('premium', load_premium, attr='_premium')
+            Addon.objects.filter(...).prefetch('premium')
+
+        Objects that already have ``attr`` are skipped.  Set ``locale_free``
+        if the loaded objects don't have translations, so the results can
+        still be cached once for every locale.  Subclasses inherit their
+        parents' loaders.
+        """
+        @functools.wraps(loader)
+        def wrapper(objs):
+            if attr is not None:
+                objs = [obj for obj in objs if attr not in obj.__dict__]
+            if objs:
+                loader(objs)
+        wrapper.locale_free = locale_free
+        wrapper.transform_key = '%s.%s:prefetch:%s' % (cls.__module__,
+                                                      cls.__name__, name)
+        _prefetchers.setdefault(cls, {})[name] = wrapper
+        return loader
+
     def update(self, **kw):
         """
         Shortcut for doing an UPDATE on this object.
 
         If _signal=False is in ``kw`` the post_save signal won't be sent.
+        Inside coalesce_updates() the UPDATE is put off until the block ends.
         """
+        if _coalesce(self, kw):
+            return
         signal = kw.pop('_signal', True)
         cls = self.__class__
         for k, v in kw.items():
             setattr(self, k, v)
         if signal:
             # Detect any attribute changes during pre_save and add those to the
-            # update kwargs.
-            attrs = dict(self.__dict__)
+            # update kwargs.  Handlers can rewrite the fields being updated
+            # too, and then their value is the one written.
+            fields = dict((f.attname, f.name) for f in self._meta.fields)
+            before = dict((k, self.__dict__.get(k)) for k in fields)
             models.signals.pre_save.send(sender=cls, instance=self)
-            for k, v in self.__dict__.items():
-                if attrs[k] != v:
-                    kw[k] = v
-                    setattr(self, k, v)
+            for k, old in before.items():
+                if old != self.__dict__.get(k):
+                    for name in [n for n in kw if _attname(cls, n) == k]:
+                        del kw[name]
+                    kw[fields[k]] = self.__dict__[k]
         cls.objects.filter(pk=self.pk).update(**kw)
+        # The columns we just wrote aren't dirty anymore.
+        dirty = self.__dict__.get('_dirty_attr')
+        if dirty:
+            for k in kw:
+                dirty.pop(_attname(cls, k), None)
+        indexing.queue(self, kw.keys())
         if signal:
             models.signals.post_save.send(sender=cls, instance=self,
                                           created=False)
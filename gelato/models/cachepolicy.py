@@ -0,0 +1,86 @@
+"""
+How ManagerBase querysets use the cache.
+
+``READ_THROUGH``
+    The default: results come from the cache, and misses are cached.
+``REFRESH``
+    Always query the database and replace what's cached with the results.
+``BYPASS``
+    Don't read or write the cache at all.
+
+Policies are scoped with :func:`cache_policy`::
+
+    with cache_policy(REFRESH):
+        addon = Addon.objects.get(id=id)
+
+The policy is kept in a ``contextvars.ContextVar`` where that's available so
+each thread and coroutine has its own, and in a thread local otherwise.
+"""
+import collections
+import contextlib
+import threading
+
+from django_statsd.clients import statsd
+
+try:
+    from contextvars import ContextVar
+except ImportError:
+    ContextVar = None
+
+
+READ_THROUGH = 'read-through'
+REFRESH = 'refresh'
+BYPASS = 'bypass'
+POLICIES = (READ_THROUGH, REFRESH, BYPASS)
+
+# {policy: number of querysets evaluated under it} in this process.
+counts = collections.defaultdict(int)
+
+
+class _LocalVar(object):
+    """Just enough of ContextVar, kept in a thread local."""
+
+    def __init__(self, name, default):
+        self.name = name
+        self.default = default
+        self._local = threading.local()
+
+    def get(self):
+        return getattr(self._local, 'value', self.default)
+
+    def set(self, value):
+        token = self.get()
+        self._local.value = value
+        return token
+
+    def reset(self, token):
+        self._local.value = token
+
+
+if ContextVar is not None:
+    _policy = ContextVar('cache_policy', default=READ_THROUGH)
+else:
+    _policy = _LocalVar('cache_policy', default=READ_THROUGH)
+
+
+def get_policy():
+    """The policy in effect in the current context."""
+    return _policy.get()
+
+
+@contextlib.contextmanager
+def cache_policy(policy):
+    """Use ``policy`` for the querysets evaluated within this context."""
+    if policy not in POLICIES:
+        raise ValueError('Unknown cache policy: %r' % policy)
+    token = _policy.set(policy)
+    try:
+        yield
+    finally:
+        _policy.reset(token)
+
+
+def count(policy):
+    """Record that a queryset was evaluated under ``policy``."""
+    counts[policy] += 1
+    statsd.incr('cache.policy.%s' % policy)
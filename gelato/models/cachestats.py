@@ -0,0 +1,159 @@
+"""
+Numbers on how well the cache serves ManagerBase querysets.
+
+Every evaluated queryset is counted in statsd under
+``cache.model.<app>.<model>.<outcome>``.  The outcome is one of:
+
+``hit``
+    Served from the cache.
+``miss``
+    Queried and cached.
+``refresh``
+    Queried under the REFRESH policy.
+``bypass``
+    Queried without the cache, through ``no_cache()`` or the BYPASS policy.
+``negative_hit``
+    A get() answered by a cached miss (see ``negative_cache_fields``).
+
+A sample of misses (``settings.CACHE_STATS_SAMPLE_RATE``, 1% by default)
+also has the size of its pickled results sent as
+``cache.bytes.<app>.<model>``.  For another sample of the queries that
+didn't come from the cache (``settings.CACHE_STATS_SHAPE_SAMPLE_RATE``, 10%
+by default) the time spent is totalled by SQL shape, and the costliest
+``settings.CACHE_STATS_TOP_N`` shapes are logged every
+``settings.CACHE_STATS_REPORT_INTERVAL`` seconds.  Compiling the SQL costs
+about as much as building the query did, so it isn't done for every one.
+"""
+import collections
+import cPickle as pickle
+import logging
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.db.models.sql.datastructures import EmptyResultSet
+
+import caching.base
+from django_statsd.clients import statsd
+
+from gelato.models import cachepolicy
+
+
+log = logging.getLogger('z.cache')
+
+# {(model label, outcome): count} in this process.
+counts = collections.defaultdict(int)
+
+# Don't let an endless variety of SQL eat the memory.
+MAX_SHAPES = 1000
+
+_shapes = {}  # {sql: [queries, total ms]}
+_lock = threading.Lock()
+_last_report = [time.time()]
+
+
+def _label(model):
+    return '%s.%s' % (model._meta.app_label, model._meta.module_name)
+
+
+def _outcome(qs, policy, from_cache):
+    if (policy == cachepolicy.BYPASS or
+            qs.timeout == getattr(caching.base, 'NO_CACHE', -1)):
+        return 'bypass'
+    elif policy == cachepolicy.REFRESH:
+        return 'refresh'
+    return 'hit' if from_cache else 'miss'
+
+
+def observe(qs, objs, policy):
+    """
+    Pass through the objects from ``qs``, recording how they were served.
+
+    Only the time spent getting the objects counts, not the time the caller
+    spends on them in between.  Querysets that aren't read to the end are
+    recorded when they're let go.
+    """
+    rate = getattr(settings, 'CACHE_STATS_SAMPLE_RATE', 0.01)
+    sample = random.random() < rate
+    shape_rate = getattr(settings, 'CACHE_STATS_SHAPE_SAMPLE_RATE', 0.1)
+    shape = random.random() < shape_rate
+    kept, from_cache, ms, failed = [], False, 0.0, False
+    objs = iter(objs)
+    try:
+        while True:
+            start = time.time()
+            try:
+                obj = next(objs)
+            except StopIteration:
+                break
+            finally:
+                ms += (time.time() - start) * 1000
+            from_cache = from_cache or getattr(obj, 'from_cache', False)
+            if sample:
+                kept.append(obj)
+            yield obj
+    except Exception:
+        failed = True
+        raise
+    finally:
+        if not failed:
+            _record(qs, policy, from_cache, sample and kept, ms, shape)
+
+
+def _record(qs, policy, from_cache, kept, ms, shape=True):
+    label = _label(qs.model)
+    outcome = _outcome(qs, policy, from_cache)
+    count(qs.model, outcome)
+    if outcome == 'hit':
+        return
+    if kept and outcome == 'miss':
+        statsd.timing('cache.bytes.%s' % label,
+                      len(pickle.dumps(kept, pickle.HIGHEST_PROTOCOL)))
+    if not shape:
+        return
+    try:
+        sql = qs.query.sql_with_params()[0]
+    except EmptyResultSet:
+        return
+    record_shape(sql, ms)
+
+
+def count(model, outcome):
+    label = _label(model)
+    counts[label, outcome] += 1
+    statsd.incr('cache.model.%s.%s' % (label, outcome))
+
+
+def record_shape(sql, ms):
+    with _lock:
+        if sql in _shapes:
+            _shapes[sql][0] += 1
+            _shapes[sql][1] += ms
+        elif len(_shapes) < MAX_SHAPES:
+            _shapes[sql] = [1, ms]
+    interval = getattr(settings, 'CACHE_STATS_REPORT_INTERVAL', 300)
+    if time.time() - _last_report[0] > interval:
+        log_report()
+
+
+def report(n=None):
+    """
+    The ``n`` SQL shapes that took the most time outside the cache, as
+    (sql, queries, total ms) tuples.
+    """
+    if n is None:
+        n = getattr(settings, 'CACHE_STATS_TOP_N', 20)
+    with _lock:
+        shapes = [(sql, q, ms) for sql, (q, ms) in _shapes.items()]
+    return sorted(shapes, key=lambda s: s[2], reverse=True)[:n]
+
+
+def log_report():
+    """Log the costliest uncached shapes and start counting again."""
+    top = report()
+    with _lock:
+        _shapes.clear()
+        _last_report[0] = time.time()
+    for sql, queries, ms in top:
+        log.info('Uncached: %.0fms over %s queries: %s' % (ms, queries, sql))
@@ -0,0 +1,237 @@
+"""
+Pooled Elasticsearch clients.
+
+Interactive searches and indexing get separate pools so a big reindex can't
+starve page requests of connections.  Pools are configured through
+``settings.ES_POOLS``, which is merged over ``DEFAULT_POOLS``::
+
+    ES_POOLS = {
+        'search': {'size': 20, 'keepalive': 60, 'timeout': 3},
+        'index': {'size': 4, 'keepalive': 300, 'timeout': 60},
+    }
+
+pyes queues bulk requests on the client that made them, so bulk indexing
+goes through the ``bulk`` pool, which holds a single client.  Everything
+queued in the process ends up on that client, and :func:`flush_bulk` (or
+``SearchMixin.flush_bulk()``) can always reach it.  It's also flushed when
+each request finishes and when the process exits.
+
+``size`` caps the number of clients handed out at once, ``keepalive`` is how
+many seconds an idle client is kept for reuse and ``timeout`` is the socket
+timeout used for every operation made through that pool.  Pools that don't
+set a ``timeout`` use ``settings.ES_TIMEOUT`` if it's set.  Requests are
+written out as curl commands to ``settings.ES_DUMP_CURL``, a file or a path,
+like elasticutils did.
+
+Use :func:`get_es` to borrow a client::
+
+    with esclients.get_es('index') as es:
+        es.index(doc, index, doc_type, id=id)
+
+"""
+import atexit
+import collections
+import contextlib
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core import signals
+from django.utils import importlib
+
+import pyes
+from django_statsd.clients import statsd
+
+
+DEFAULT_POOLS = {
+    'search': {'size': 10, 'keepalive': 60, 'timeout': 5},
+    'index': {'size': 2, 'keepalive': 300, 'timeout': 30},
+    'bulk': {'size': 1, 'keepalive': 60 * 60, 'timeout': 30},
+}
+
+log = logging.getLogger('z.es')
+
+_pools = {}
+_pools_lock = threading.Lock()
+_dump_files = {}
+
+
+def _dump_curl():
+    """Where clients should write their requests as curl commands."""
+    dump = getattr(settings, 'ES_DUMP_CURL', False)
+    if not dump or hasattr(dump, 'write'):
+        return dump
+    # A path, which every client appends to.
+    with _pools_lock:
+        if dump not in _dump_files:
+            _dump_files[dump] = open(dump, 'a')
+        return _dump_files[dump]
+
+
+def new_client(timeout):
+    """Create a new pyes client for the configured cluster."""
+    return pyes.ES(settings.ES_HOSTS, timeout=timeout,
+                   default_indexes=[settings.ES_INDEXES['default']],
+                   dump_curl=_dump_curl())
+
+
+def get_factory():
+    """
+    The callable used to create clients.  ``settings.ES_CLIENT_FACTORY`` can
+    name a replacement, like the in-memory ``memsearch.MemoryES``.
+    """
+    path = getattr(settings, 'ES_CLIENT_FACTORY', None)
+    if not path:
+        return new_client
+    module, attr = path.rsplit('.', 1)
+    return getattr(importlib.import_module(module), attr)
+
+
+class ClientPool(object):
+    """A bounded pool of reusable ES clients."""
+
+    def __init__(self, name, size, keepalive, timeout, factory=new_client):
+        self.name = name
+        self.size = size
+        self.keepalive = keepalive
+        self.timeout = timeout
+        self.factory = factory
+        self.stats = collections.defaultdict(int)
+        self._idle = collections.deque()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+        self._in_use = 0
+
+    def __repr__(self):
+        return '<%s %s size=%s>' % (self.__class__.__name__, self.name,
+                                    self.size)
+
+    def _count(self, stat):
+        self.stats[stat] += 1
+        statsd.incr('search.es.pool.%s.%s' % (self.name, stat))
+
+    def _discard(self, client):
+        # Anything queued for a bulk request would be lost with the client.
+        try:
+            client.flush_bulk(forced=True)
+        except Exception:
+            self._count('errors')
+
+    def acquire(self):
+        """Check a client out of the pool, blocking while the pool is full."""
+        with statsd.timer('search.es.pool.%s.wait' % self.name):
+            self._slots.acquire()
+        client, expired, now = None, [], time.time()
+        with self._lock:
+            while self._idle:
+                idle, last_used = self._idle.pop()
+                if now - last_used < self.keepalive:
+                    client = idle
+                    break
+                expired.append(idle)
+            self._in_use += 1
+        for idle in expired:
+            self._count('expired')
+            self._discard(idle)
+
+        if client is None:
+            try:
+                client = self.factory(timeout=self.timeout)
+            except Exception:
+                with self._lock:
+                    self._in_use -= 1
+                self._slots.release()
+                raise
+            self._count('created')
+        else:
+            self._count('reused')
+        return client
+
+    def release(self, client, discard=False):
+        """Return a client to the pool, or drop it if ``discard`` is True."""
+        with self._lock:
+            self._in_use -= 1
+            if not discard:
+                self._idle.append((client, time.time()))
+        self._slots.release()
+
+    @contextlib.contextmanager
+    def client(self):
+        client = self.acquire()
+        try:
+            yield client
+        except Exception:
+            # The connection may be in a bad state, so don't reuse it.
+            self._count('errors')
+            try:
+                self._discard(client)
+            finally:
+                self.release(client, discard=True)
+            raise
+        else:
+            self.release(client)
+
+    def flush_bulk(self):
+        """Send any bulk requests queued on the idle clients."""
+        with self._lock:
+            idle = [c for c, _ in self._idle]
+        for client in idle:
+            client.flush_bulk(forced=True)
+
+    def health(self):
+        with self._lock:
+            rv = dict(self.stats, idle=len(self._idle), in_use=self._in_use,
+                      size=self.size)
+        return rv
+
+
+def get_pool(name):
+    """Get (creating it if needed) the pool called ``name``."""
+    try:
+        return _pools[name]
+    except KeyError:
+        pass
+    with _pools_lock:
+        if name not in _pools:
+            config = dict(DEFAULT_POOLS.get(name, DEFAULT_POOLS['search']))
+            if hasattr(settings, 'ES_TIMEOUT'):
+                config['timeout'] = settings.ES_TIMEOUT
+            config.update(getattr(settings, 'ES_POOLS', {}).get(name, {}))
+            config.setdefault('factory', get_factory())
+            _pools[name] = ClientPool(name, **config)
+        return _pools[name]
+
+
+def get_es(pool='search'):
+    """Borrow a client from ``pool`` for the duration of a with block."""
+    return get_pool(pool).client()
+
+
+def flush_bulk(pool='bulk'):
+    """Send the bulk requests queued on ``pool``'s clients."""
+    if pool not in _pools:
+        # No clients, so nothing queued.
+        return
+    if get_pool(pool).size == 1:
+        # Wait for the only client, so it's flushed even if it's in use.
+        with get_es(pool) as es:
+            es.flush_bulk(forced=True)
+    else:
+        get_pool(pool).flush_bulk()
+
+
+def health():
+    """Usage counters and current occupancy for every pool in use."""
+    return dict((name, p.health()) for name, p in _pools.items())
+
+
+def _flush_queued(**kw):
+    try:
+        flush_bulk()
+    except Exception:
+        log.error('Could not send the queued bulk requests.', exc_info=True)
+
+signals.request_finished.connect(_flush_queued,
+                                 dispatch_uid='esclients.flush_queued')
+atexit.register(_flush_queued)
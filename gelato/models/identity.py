@@ -0,0 +1,105 @@
+"""
+A request-scoped identity map for ModelBase instances.
+
+While the map is on, instances loaded through ``objects`` are kept by
+(model, pk) and the same instance is handed back whenever that row is loaded
+again.  Lookups by pk like ``Addon.objects.get(pk=1)`` or following a foreign
+key don't query at all.  Each transform only runs once on an instance, even
+when the instance comes back from querysets with different transforms.  Turn
+it on for every request with ``settings.IDENTITY_MAP = True``, or for a block
+of code with :func:`identity_map`.
+
+Instances are shared, so changes made through one of them are seen
+everywhere in the request.  Writes that don't go through an instance, like
+``QuerySet.update()``, aren't seen until the map is cleared.  Querysets
+evaluated under the REFRESH or BYPASS cache policies skip the map, and so do
+ones with ``extra(select=...)`` or ``annotate()`` columns.  Instances are
+swapped in after the queryset cache, so the cache only ever holds the rows.
+"""
+import contextlib
+import threading
+
+from django.conf import settings
+from django.core import signals
+from django.db import models
+
+
+_local = threading.local()
+
+
+def _map():
+    return getattr(_local, 'map', None)
+
+
+def active():
+    """Whether the identity map is on in this thread."""
+    return _map() is not None
+
+
+def _key(obj):
+    if obj.pk is None or getattr(obj, '_deferred', False):
+        # Deferred instances are missing fields, so they can't stand in for
+        # complete ones.
+        return None
+    return obj.__class__, obj.pk
+
+
+def get(model, pk):
+    """The instance of ``model`` with ``pk`` in the map, or None."""
+    m = _map()
+    return None if m is None else m.get((model, pk))
+
+
+def add(obj):
+    """Put ``obj`` in the map, returning the instance that's there now."""
+    m, key = _map(), _key(obj)
+    if m is None or key is None:
+        return obj
+    return m.setdefault(key, obj)
+
+
+def merge(objs):
+    """Swap in the instances already in the map, and add the rest."""
+    for obj in objs:
+        yield add(obj)
+
+
+def clear():
+    m = _map()
+    if m is not None:
+        m.clear()
+
+
+@contextlib.contextmanager
+def identity_map():
+    """Share instances loaded within this context.  Nested blocks join in."""
+    if active():
+        yield
+        return
+    _local.map = {}
+    try:
+        yield
+    finally:
+        _local.map = None
+
+
+def _deleted(sender, instance, **kw):
+    m, key = _map(), _key(instance)
+    if m is not None and key is not None:
+        m.pop(key, None)
+
+models.signals.post_delete.connect(_deleted, dispatch_uid='identity.deleted')
+
+
+def _request_started(**kw):
+    if getattr(settings, 'IDENTITY_MAP', False):
+        _local.map = {}
+
+
+def _request_finished(**kw):
+    _local.map = None
+
+signals.request_started.connect(_request_started,
+                                dispatch_uid='identity.request_started')
+signals.request_finished.connect(_request_finished,
+                                 dispatch_uid='identity.request_finished')
@@ -0,0 +1,201 @@
+"""
+Index models in ES after their changes are committed.
+
+Saves and updates on models with ``index_on_change = True`` record the
+object's (model, pk).  The ids are deduplicated and sent as one bulk index
+request per model once the transaction commits, or dropped if it's rolled
+back.  Outside of a transaction the ids are held until the end of the current
+request or :func:`batch` block, or indexed right away if there's neither.
+Committed ids are indexed once the outermost transaction management block is
+left, since the indexing queries can't run inside it.  The hooks into
+Django's transaction functions are installed in :mod:`gelato.models._fixes`.
+
+If every attribute that changed is listed in the model's
+``partial_index_fields`` only those document fields are sent, in a partial
+update, instead of rebuilding the whole document.  ``auto_now`` fields that
+aren't listed are left out, so they don't force a rebuild on every save().
+"""
+import collections
+import contextlib
+import logging
+import threading
+
+from django.core import signals
+from django.db import DEFAULT_DB_ALIAS, models, router, transaction
+
+
+log = logging.getLogger('z.es')
+
+_local = threading.local()
+
+
+def _state():
+    if not hasattr(_local, 'ready'):
+        # {model: {pk: partial document, or None for a full rebuild}}.  Ids
+        # from the current transactions wait in pending, by database alias,
+        # until they commit.
+        _local.pending = collections.defaultdict(
+            lambda: collections.defaultdict(dict))
+        _local.ready = collections.defaultdict(dict)
+        _local.batching = 0
+    return _local
+
+
+def _add(entries, pk, doc):
+    if pk in entries and entries[pk] is None:
+        return
+    if doc is None:
+        entries[pk] = None
+    else:
+        entries.setdefault(pk, {}).update(doc)
+
+
+def _partial_doc(cls, changed, get):
+    """
+    Map the changed attributes to document fields, or return None if any of
+    them can't be mapped and the whole document has to be rebuilt.
+    """
+    mapping = getattr(cls, 'partial_index_fields', None)
+    if changed is None or not mapping:
+        return None
+    doc = {}
+    for name in changed:
+        try:
+            field = cls._meta.get_field(name)
+        except models.FieldDoesNotExist:
+            field = None
+        else:
+            name = field.attname
+        if name not in mapping:
+            if getattr(field, 'auto_now', False):
+                # Like ModelBase.modified, which changes on every save; it's
+                # only sent if it's mapped.
+                continue
+            return None
+        doc[mapping[name]] = get(name)
+    return doc
+
+
+def _enqueue(cls, docs, using):
+    state = _state()
+    managed = transaction.is_managed(using=using)
+    if managed:
+        entries = state.pending[using or DEFAULT_DB_ALIAS][cls]
+    else:
+        entries = state.ready[cls]
+    for pk, doc in docs.items():
+        if doc != {}:
+            # An empty doc means nothing that's indexed changed.
+            _add(entries, pk, doc)
+    if not managed:
+        _flush_if_idle(using)
+
+
+def queue(instance, changed=None):
+    """
+    Schedule ``instance`` to be reindexed once its changes are committed.
+
+    ``changed`` lists the attributes that changed, if they're known.
+    """
+    cls = instance.__class__
+    if not getattr(cls, 'index_on_change', False) or instance.pk is None:
+        return
+    doc = _partial_doc(cls, changed, lambda name: getattr(instance, name))
+    _enqueue(cls, {instance.pk: doc},
+             router.db_for_write(cls, instance=instance))
+
+
+def queue_changes(cls, changes):
+    """
+    Schedule rows of ``cls`` changed without loading them to be reindexed.
+
+    ``changes`` maps each pk to a dict of the new values of the attributes
+    that changed.
+    """
+    if not getattr(cls, 'index_on_change', False) or not changes:
+        return
+    _enqueue(cls, dict((pk, _partial_doc(cls, values, values.get))
+                       for pk, values in changes.items()),
+             router.db_for_write(cls))
+
+
+def flush():
+    """Index everything that has been committed so far."""
+    state = _state()
+    ready, state.ready = state.ready, collections.defaultdict(dict)
+    for cls, entries in ready.items():
+        full = sorted(pk for pk, doc in entries.items() if doc is None)
+        partial = dict((pk, doc) for pk, doc in entries.items() if doc)
+        if partial:
+            try:
+                # Documents that couldn't be updated come back to us.
+                full.extend(cls.partial_index(partial))
+            except Exception:
+                log.error('Partial indexing %s %s failed, indexing them in '
+                          'full.' % (cls.__name__, sorted(partial)),
+                          exc_info=True)
+                full.extend(partial)
+        if full:
+            try:
+                cls.index_ids(sorted(set(full)))
+            except Exception:
+                log.error('Indexing %s %s failed.' % (cls.__name__,
+                                                      sorted(set(full))),
+                          exc_info=True)
+
+
+def _flush_if_idle(using=None):
+    # Indexing queries the database, which isn't allowed at the end of a
+    # transaction management block; left_transaction() flushes after it.
+    if not _state().batching and not transaction.is_managed(using=using):
+        flush()
+
+
+@contextlib.contextmanager
+def batch():
+    """Hold autocommitted changes until the block exits, then index them."""
+    state = _state()
+    state.batching += 1
+    try:
+        yield
+    finally:
+        state.batching -= 1
+        _flush_if_idle()
+
+
+def committed(using=None):
+    """Called after a commit: the pending ids on ``using`` are ready."""
+    state = _state()
+    for cls, entries in state.pending.pop(using or DEFAULT_DB_ALIAS,
+                                          {}).items():
+        for pk, doc in entries.items():
+            _add(state.ready[cls], pk, doc)
+    _flush_if_idle(using)
+
+
+def rolled_back(using=None):
+    """Called after a rollback: forget the pending ids on ``using``."""
+    _state().pending.pop(using or DEFAULT_DB_ALIAS, None)
+
+
+def left_transaction(using=None):
+    """
+    Called after a transaction management block is left.  Once we're out of
+    the outermost one the connection is free for the indexing queries.
+    """
+    _flush_if_idle(using)
+
+
+def _request_started(**kw):
+    _state().batching += 1
+
+
+def _request_finished(**kw):
+    state = _state()
+    state.batching = max(state.batching - 1, 0)
+    _flush_if_idle()
+
+signals.request_started.connect(_request_started,
+                                dispatch_uid='indexing.request_started')
+signals.request_finished.connect(_request_finished,
+                                 dispatch_uid='indexing.request_finished')
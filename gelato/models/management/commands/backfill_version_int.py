@@ -0,0 +1,54 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+
+from gelato.models.applications import AppVersion
+from gelato.models.versions import VersionBase, version_ints
+
+
+MODELS = {'versions': VersionBase, 'appversions': AppVersion}
+
+
+class Command(BaseCommand):
+    help = ('Fill in version_int for versions and app versions that are '
+            'missing it.  Safe to stop and run again.')
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', type='int', default=1000,
+                    help='Rows to read and write at a time.'),
+        make_option('--after', type='int', default=0,
+                    help='Start after this pk, to resume a run.  Needs '
+                         '--model, since the pks are per table.'),
+        make_option('--model', choices=sorted(MODELS), default=None,
+                    help='Only backfill this table.'),
+    )
+
+    def handle(self, *args, **options):
+        if options['after'] and not options['model']:
+            raise CommandError('--after needs --model.')
+        names = [options['model']] if options['model'] else sorted(MODELS)
+        for name in names:
+            self.backfill(MODELS[name], options['chunk_size'],
+                          options['after'])
+
+    def backfill(self, model, chunk_size, after):
+        # AppVersion.version_int isn't nullable, so missing ones are 0.
+        missing = model.uncached.filter(Q(version_int__isnull=True) |
+                                        Q(version_int=0))
+        done = 0
+        while True:
+            # Walk the pks instead of using OFFSET, so each chunk is cheap
+            # and the last pk printed is a place to pick up from.
+            rows = list(missing.filter(pk__gt=after).order_by('pk')
+                        .values_list('pk', 'version')[:chunk_size])
+            if not rows:
+                break
+            ints = version_ints([version for pk, version in rows])
+            model.objects.bulk_update(
+                [(model(pk=pk), {'version_int': vint})
+                 for (pk, _), vint in zip(rows, ints)],
+                chunk_size=chunk_size)
+            after = rows[-1][0]
+            done += len(rows)
+            self.stdout.write('%s: %s rows done, up to pk %s\n'
+                              % (model._meta.db_table, done, after))
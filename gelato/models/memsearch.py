@@ -0,0 +1,362 @@
+"""
+An in-process stand-in for Elasticsearch.
+
+This implements the parts of the pyes client and the query DSL that
+:class:`gelato.models.search.ES` and :class:`gelato.models.base.SearchMixin`
+use, so the search layer can be run and benchmarked without a cluster.  Point
+the client pools at it with::
+
+    ES_CLIENT_FACTORY = 'gelato.models.memsearch.MemoryES'
+
+All clients share one module-level store unless they're given their own.
+"""
+import collections
+import copy
+import datetime
+import json
+import re
+import threading
+import time
+import uuid
+
+import pyes.exceptions
+
+from gelato.models.search import _json_default
+
+
+_store = collections.defaultdict(dict)
+_lock = threading.RLock()
+
+words = re.compile(r'\w+', re.UNICODE)
+script_assign = re.compile(r'ctx\._source\.(\w+) = (\w+)')
+
+
+def reset():
+    """Drop every document in the shared store."""
+    with _lock:
+        _store.clear()
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [value]
+
+
+def _comparable(a, b):
+    """Dates come back from JSON as strings, so compare them that way."""
+    if isinstance(a, (datetime.datetime, datetime.date)):
+        a = a.isoformat()
+    if isinstance(b, (datetime.datetime, datetime.date)):
+        b = b.isoformat()
+    return a, b
+
+
+def _tokens(value):
+    return set(w.lower() for v in _as_list(value)
+               for w in words.findall(unicode(v)))
+
+
+def _distance(a, b):
+    """Levenshtein distance between two strings."""
+    prev = range(len(b) + 1)
+    for i, ca in enumerate(a, 1):
+        cur = [i]
+        for j, cb in enumerate(b, 1):
+            cur.append(min(prev[j] + 1, cur[j - 1] + 1,
+                           prev[j - 1] + (ca != cb)))
+        prev = cur
+    return prev[-1]
+
+
+def _field(clause):
+    """Split a {field: value} clause, ignoring options like _cache."""
+    items = [(k, v) for k, v in clause.items() if not k.startswith('_')]
+    return items[0]
+
+
+def _in_range(values, bounds):
+    ops = {'gt': lambda a, b: a > b, 'gte': lambda a, b: a >= b,
+           'lt': lambda a, b: a < b, 'lte': lambda a, b: a <= b,
+           'from': lambda a, b: a >= b, 'to': lambda a, b: a <= b}
+    for value in values:
+        if value is None:
+            continue
+        if all(ops[op](*_comparable(value, bound))
+               for op, bound in bounds.items() if op in ops):
+            return True
+    return False
+
+
+def _sub_filters(value):
+    return value['filters'] if hasattr(value, 'items') else value
+
+
+def match_filter(f, doc):
+    """Whether ``doc`` passes the filter ``f``."""
+    (kind, value), = [(k, v) for k, v in f.items() if k != '_cache']
+    if kind == 'match_all':
+        return True
+    elif kind == 'term':
+        field, term = _field(value)
+        return any(v == term for v in _as_list(doc.get(field)))
+    elif kind in ('in', 'terms'):
+        field, terms = _field(value)
+        return any(v in terms for v in _as_list(doc.get(field)))
+    elif kind == 'range':
+        field, bounds = _field(value)
+        return _in_range(_as_list(doc.get(field)), bounds)
+    elif kind == 'and':
+        return all(match_filter(sub, doc) for sub in _sub_filters(value))
+    elif kind == 'or':
+        return any(match_filter(sub, doc) for sub in _sub_filters(value))
+    elif kind == 'not':
+        return not match_filter(value.get('filter', value), doc)
+    elif kind == 'bool':
+        return _match_bool(value, doc, match_filter) is not None
+    raise NotImplementedError('Filter %r is not supported.' % kind)
+
+
+def _match_bool(value, doc, match):
+    must = _as_list(value.get('must'))
+    should = _as_list(value.get('should'))
+    must_not = _as_list(value.get('must_not'))
+    score = 0
+    for clause in must:
+        rv = match(clause, doc)
+        if not rv:
+            return None
+        score += rv
+    if any(match(clause, doc) for clause in must_not):
+        return None
+    matched = [match(clause, doc) for clause in should]
+    if should and not must and not any(matched):
+        return None
+    return score + sum(m for m in matched if m) or 1
+
+
+def match_query(q, doc):
+    """Score ``doc`` against the query ``q``, or 0 if it doesn't match."""
+    (kind, value), = q.items()
+    if kind == 'match_all':
+        return 1
+    elif kind == 'term':
+        field, term = _field(value)
+        return int(any(v == term for v in _as_list(doc.get(field))))
+    elif kind == 'text':
+        field, text = _field(value)
+        if hasattr(text, 'items'):
+            text = text['query']
+        return len(_tokens(text) & _tokens(doc.get(field)))
+    elif kind == 'prefix':
+        field, prefix = _field(value)
+        prefix = prefix.lower()
+        return int(any(unicode(v).lower().startswith(prefix)
+                       for v in _as_list(doc.get(field))))
+    elif kind == 'fuzzy':
+        field, term = _field(value)
+        if hasattr(term, 'items'):
+            term = term['value']
+        term = unicode(term).lower()
+        # ES defaults to a similarity of 0.5 for fuzzy queries.
+        return int(any(_distance(term, t) <= max(len(term) // 2, 1)
+                       for t in _tokens(doc.get(field))))
+    elif kind == 'range':
+        field, bounds = _field(value)
+        return int(_in_range(_as_list(doc.get(field)), bounds))
+    elif kind == 'bool':
+        return _match_bool(value, doc, match_query) or 0
+    elif kind == 'filtered':
+        if not match_filter(value['filter'], doc):
+            return 0
+        return match_query(value.get('query', {'match_all': {}}), doc)
+    raise NotImplementedError('Query %r is not supported.' % kind)
+
+
+def _sort_key(sort):
+    specs = []
+    for spec in sort:
+        if hasattr(spec, 'items'):
+            field, order = spec.items()[0]
+            if hasattr(order, 'items'):
+                order = order.get('order', 'asc')
+        else:
+            field, order = spec, 'desc' if spec == '_score' else 'asc'
+        specs.append((field, order == 'desc'))
+    return specs
+
+
+def _sort(hits, sort):
+    # Stable sorts applied from the last key to the first give a multi-key
+    # sort with mixed directions.
+    for field, reverse in reversed(_sort_key(sort)):
+        if field == '_score':
+            key = lambda h: h['_score']
+        else:
+            key = lambda h, f=field: h['_doc'].get(f)
+        hits.sort(key=key, reverse=reverse)
+    return hits
+
+
+def _facet(spec, docs):
+    if 'terms' in spec:
+        opts = spec['terms']
+        counts = collections.defaultdict(int)
+        missing = 0
+        for doc in docs:
+            values = _as_list(doc.get(opts['field']))
+            if not values:
+                missing += 1
+            for v in values:
+                counts[v] += 1
+        terms = sorted(counts.items(), key=lambda tc: (-tc[1], tc[0]))
+        size = opts.get('size', 10)
+        return {'_type': 'terms', 'missing': missing,
+                'total': sum(counts.values()),
+                'other': sum(c for t, c in terms[size:]),
+                'terms': [{'term': t, 'count': c} for t, c in terms[:size]]}
+    elif 'range' in spec:
+        opts = spec['range']
+        ranges = []
+        for r in opts['ranges']:
+            bounds = {}
+            if 'from' in r:
+                bounds['gte'] = r['from']
+            if 'to' in r:
+                bounds['lt'] = r['to']
+            count = sum(1 for doc in docs
+                        if _in_range(_as_list(doc.get(opts['field'])),
+                                     bounds))
+            ranges.append(dict(r, count=count))
+        return {'_type': 'range', 'ranges': ranges}
+    raise NotImplementedError('Facet %r is not supported.' % spec.keys())
+
+
+class MemoryES(object):
+    """Enough of pyes.ES to stand in for a cluster in tests and benchmarks."""
+
+    def __init__(self, timeout=None, store=None, **kw):
+        self.store = _store if store is None else store
+
+    def _docs(self, indexes, doc_types):
+        indexes, doc_types = _as_list(indexes), _as_list(doc_types)
+        with _lock:
+            for (index, doc_type), docs in self.store.items():
+                if ((not indexes or index in indexes) and
+                        (not doc_types or doc_type in doc_types)):
+                    for id, doc in docs.items():
+                        yield index, doc_type, id, doc
+
+    def index(self, doc, index, doc_type, id=None, bulk=False,
+              force_insert=False, **kw):
+        id = unicode(id) if id is not None else uuid.uuid4().hex
+        # Round-trip through JSON so we store what ES would give back.
+        doc = json.loads(json.dumps(doc, default=_json_default))
+        with _lock:
+            docs = self.store.setdefault((index, doc_type), {})
+            if force_insert and id in docs:
+                raise pyes.exceptions.ElasticSearchException(
+                    'Document %s already exists.' % id, status=409)
+            docs[id] = doc
+        return {'ok': True, '_index': index, '_type': doc_type, '_id': id}
+
+    def delete(self, index, doc_type, id, **kw):
+        with _lock:
+            try:
+                del self.store[(index, doc_type)][unicode(id)]
+            except KeyError:
+                raise pyes.exceptions.NotFoundException(
+                    'Document %s not found.' % id, status=404)
+        return {'ok': True, 'found': True, '_id': unicode(id)}
+
+    def get(self, index, doc_type, id, **kw):
+        with _lock:
+            try:
+                doc = self.store[(index, doc_type)][unicode(id)]
+            except KeyError:
+                raise pyes.exceptions.NotFoundException(
+                    'Document %s not found.' % id, status=404)
+            return {'_index': index, '_type': doc_type, '_id': unicode(id),
+                    'exists': True, '_source': copy.deepcopy(doc)}
+
+    def flush_bulk(self, forced=False):
+        pass
+
+    def refresh(self, *args, **kw):
+        pass
+
+    def search(self, query, indexes=None, doc_types=None, **kw):
+        start = time.time()
+        q = query.get('query', {'match_all': {}})
+        f = query.get('filter')
+
+        matched, hits = [], []
+        for index, doc_type, id, doc in self._docs(indexes, doc_types):
+            score = match_query(q, doc)
+            if not score:
+                continue
+            # The top-level filter doesn't apply to facets.
+            matched.append(doc)
+            if f and not match_filter(f, doc):
+                continue
+            hits.append({'_index': index, '_type': doc_type, '_id': id,
+                         '_score': float(score), '_doc': doc})
+
+        _sort(hits, query.get('sort') or ['_score'])
+        offset = query.get('from', 0)
+        page = hits[offset:offset + query.get('size', 10)]
+        fields = query.get('fields')
+        for hit in page:
+            doc = copy.deepcopy(hit.pop('_doc'))
+            if fields is None:
+                hit['_source'] = doc
+            else:
+                hit['fields'] = dict((k, doc[k]) for k in fields if k in doc)
+
+        rv = {'took': int((time.time() - start) * 1000), 'timed_out': False,
+              'hits': {'total': len(hits), 'hits': page,
+                       'max_score': max([h['_score'] for h in page] or [0])}}
+        facets = query.get('facets')
+        if facets:
+            rv['facets'] = dict((name, _facet(spec, matched))
+                                for name, spec in facets.items())
+        return rv
+
+    def _msearch(self, body):
+        lines = [json.loads(l) for l in body.splitlines() if l.strip()]
+        responses = []
+        for header, query in zip(lines[::2], lines[1::2]):
+            try:
+                responses.append(self.search(query, header.get('index'),
+                                             header.get('type')))
+            except Exception, e:
+                responses.append({'error': unicode(e)})
+        return {'responses': responses}
+
+    def _update(self, index, doc_type, id, body):
+        if not hasattr(body, 'items'):
+            body = json.loads(body)
+        # Only the assignments SearchMixin.partial_index sends are supported.
+        assignments = script_assign.findall(body['script'])
+        with _lock:
+            try:
+                doc = self.store[(index, doc_type)][id]
+            except KeyError:
+                # ES doesn't answer this one with a NotFoundException.
+                raise pyes.exceptions.ElasticSearchException(
+                    'DocumentMissingException[[%s][%s]: document missing]'
+                    % (index, id), status=404)
+            for field, param in assignments:
+                doc[field] = json.loads(json.dumps(body['params'][param],
+                                                   default=_json_default))
+        return {'ok': True, '_index': index, '_type': doc_type, '_id': id}
+
+    def _send_request(self, method, path, body=None, params=None, **kw):
+        parts = path.strip('/').split('/')
+        if parts[-1] == '_msearch':
+            return self._msearch(body)
+        elif parts[-1] == '_update' and len(parts) == 4:
+            return self._update(parts[0], parts[1], parts[2], body)
+        raise NotImplementedError('%s %s is not supported.' % (method, path))
@@ -0,0 +1,201 @@
+"""
+Send ModelBase reads to the replicas, and to the master right after writes.
+
+Add the router and the middleware to the settings::
+
+    DATABASE_ROUTERS = ('gelato.models.routers.ReplicaRouter',)
+    MIDDLEWARE_CLASSES = (
+        'gelato.models.routers.PinningMiddleware',
+        ...
+    )
+
+Replicas are the aliases in ``settings.SLAVE_DATABASES``.  Each read picks one
+at random, weighted by how far behind the master it was at the last check,
+and replicas more than ``REPLICA_MAX_LAG`` seconds behind aren't used.  Lag is
+checked with ``SHOW SLAVE STATUS`` every ``REPLICA_LAG_CHECK_INTERVAL``
+seconds.
+
+Once a thread writes, its reads go to the master for ``REPLICA_PIN_SECONDS``
+so it sees its own changes.  The middleware carries that over to the user's
+next requests with a cookie, and pins requests that aren't GET or HEAD
+since they're likely to write.  Writes are noticed from the post_save and
+post_delete signals and from :func:`wrote`, which ModelBase's
+``QuerySet.update()`` and ``bulk_update()`` call.  SQL run on a raw cursor
+has to call it too.
+
+How many reads went to each database is counted in statsd as
+``db.read.<alias>`` and in :data:`counts`.  Reads are counted by
+:func:`read` when the query runs, so querysets answered from the cache, and
+the routing cache-machine does to build its keys, aren't counted.
+"""
+import collections
+import logging
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core import signals
+from django.db import DEFAULT_DB_ALIAS, connections, models
+
+from django_statsd.clients import statsd
+
+
+log = logging.getLogger('z.db')
+
+PIN_COOKIE = 'masterpin'
+
+# {alias: reads sent there} in this process.
+counts = collections.defaultdict(int)
+
+_local = threading.local()
+_lag = {'checked': 0, 'lags': {}}
+_lag_lock = threading.Lock()
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def replicas():
+    return list(_setting('SLAVE_DATABASES', []))
+
+
+def pin(seconds=None):
+    """Read from the master in this thread for the next ``seconds``."""
+    if seconds is None:
+        seconds = _setting('REPLICA_PIN_SECONDS', 15)
+    _local.pinned_until = max(getattr(_local, 'pinned_until', 0),
+                              time.time() + seconds)
+
+
+def unpin():
+    _local.pinned_until = 0
+    _local.wrote = False
+
+
+def is_pinned():
+    return getattr(_local, 'pinned_until', 0) > time.time()
+
+
+def wrote():
+    """Note that this thread wrote to the master, and pin it there."""
+    _local.wrote = True
+    pin()
+
+
+def _replica_lag(alias):
+    """Seconds the replica is behind, or None if replication isn't running."""
+    cursor = connections[alias].cursor()
+    cursor.execute('SHOW SLAVE STATUS')
+    row = cursor.fetchone()
+    if row is None:
+        # Not a replica at all, so it can't be behind.
+        return 0
+    status = dict(zip([c[0] for c in cursor.description], row))
+    return status.get('Seconds_Behind_Master')
+
+
+def lags():
+    """{alias: seconds behind}, refreshed when the last check is too old."""
+    interval = _setting('REPLICA_LAG_CHECK_INTERVAL', 10)
+    if time.time() - _lag['checked'] < interval:
+        return _lag['lags']
+    with _lag_lock:
+        if time.time() - _lag['checked'] < interval:
+            return _lag['lags']
+        found = {}
+        for alias in replicas():
+            try:
+                found[alias] = _replica_lag(alias)
+            except Exception:
+                log.error('Could not check the lag on %s.' % alias,
+                          exc_info=True)
+                found[alias] = None
+            if found[alias] is not None:
+                statsd.gauge('db.lag.%s' % alias, found[alias])
+        _lag['lags'], _lag['checked'] = found, time.time()
+    return found
+
+
+def choose_replica():
+    """A replica picked by lag, or None if none of them are usable."""
+    max_lag = _setting('REPLICA_MAX_LAG', 30)
+    weights = [(alias, 1.0 / (1 + lag)) for alias, lag in lags().items()
+               if lag is not None and lag <= max_lag]
+    if not weights:
+        return None
+    point = random.uniform(0, sum(w for _, w in weights))
+    for alias, weight in weights:
+        point -= weight
+        if point <= 0:
+            return alias
+    return weights[-1][0]
+
+
+def _routed(model):
+    from gelato.models.base import ModelBase
+    return isinstance(model, type) and issubclass(model, ModelBase)
+
+
+def read(model, alias):
+    """Count a query on ``model`` that's being sent to ``alias``."""
+    if _routed(model):
+        counts[alias] += 1
+        statsd.incr('db.read.%s' % alias)
+
+
+class ReplicaRouter(object):
+    """Route ModelBase reads to replicas unless the thread is pinned."""
+
+    def db_for_read(self, model, **hints):
+        if not _routed(model):
+            return None
+        alias = None if is_pinned() else choose_replica()
+        return alias or DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        # This is also asked when related objects are assigned, which isn't
+        # a write, so pinning waits for the writes themselves.
+        if not _routed(model):
+            return None
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Every alias holds the same data.
+        return True
+
+    def allow_syncdb(self, db, model):
+        return None
+
+
+class PinningMiddleware(object):
+    """Keep a user on the master for a while after their requests write."""
+
+    def process_request(self, request):
+        unpin()
+        if (request.COOKIES.get(PIN_COOKIE) or
+                request.method not in ('GET', 'HEAD')):
+            pin()
+
+    def process_response(self, request, response):
+        if getattr(_local, 'wrote', False):
+            response.set_cookie(PIN_COOKIE, 'y',
+                                max_age=_setting('REPLICA_PIN_SECONDS', 15))
+        return response
+
+
+def _written(sender, **kw):
+    if _routed(sender):
+        wrote()
+
+models.signals.post_save.connect(_written, dispatch_uid='routers.post_save')
+models.signals.post_delete.connect(_written,
+                                   dispatch_uid='routers.post_delete')
+
+
+def _request_finished(**kw):
+    unpin()
+
+signals.request_finished.connect(_request_finished,
+                                 dispatch_uid='routers.request_finished')
@@ -1,11 +1,41 @@
+import datetime
+import decimal
+import functools
+import hashlib
+import json
 import logging
+import random
+import threading
 from operator import itemgetter
 
-import elasticutils.contrib.django as elasticutils
+from django.conf import settings
+from django.utils import translation
+from django.utils.encoding import force_unicode
+from django.utils.functional import Promise
+
+import pyes.exceptions
+from concurrent import futures
 from django_statsd.clients import statsd
 
+from gelato.models import esclients
+
 
 log = logging.getLogger('z.es')
+slow_log = logging.getLogger('z.es.slow')
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    """The bounded thread pool used by ES.execute_async()."""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                workers = getattr(settings, 'ES_ASYNC_WORKERS', 4)
+                _executor = futures.ThreadPoolExecutor(max_workers=workers)
+    return _executor
 
 
 class ES(object):
@@ -16,8 +46,10 @@ class ES(object):
         self.steps = []
         self.start = 0
         self.stop = None
-        self.as_list = self.as_dict = False
+        self.as_list = self.as_dict = self.as_object = False
         self._results_cache = None
+        self._future = None
+        self._query_cache = None
 
     def _clone(self, next_step=None):
         new = self.__class__(self.type, self.index)
@@ -34,34 +66,45 @@ class ES(object):
     def values_dict(self, *fields):
         return self._clone(next_step=('values_dict', fields))
 
+    def values_object(self, *fields):
+        """
+        Return read-only SourceObjects built from the stored documents
+        instead of loading the model instances from the database.
+        """
+        return self._clone(next_step=('values_object', fields))
+
     def order_by(self, *fields):
         return self._clone(next_step=('order_by', fields))
 
     def query(self, **kw):
-        return self._clone(next_step=('query', kw.items()))
+        return self._clone(next_step=('query', sorted(kw.items())))
 
     def filter(self, **kw):
-        return self._clone(next_step=('filter', kw.items()))
+        return self._clone(next_step=('filter', sorted(kw.items())))
 
     def facet(self, **kw):
-        return self._clone(next_step=('facet', kw.items()))
+        return self._clone(next_step=('facet', sorted(kw.items())))
 
     def extra(self, **kw):
         new = self._clone()
-        actions = 'values values_dict order_by query filter facet'.split()
+        actions = ('values values_dict values_object order_by query filter '
+                   'facet'.split())
         for key, vals in kw.items():
             assert key in actions
             if hasattr(vals, 'items'):
-                new.steps.append((key, vals.items()))
+                new.steps.append((key, sorted(vals.items())))
             else:
                 new.steps.append((key, vals))
         return new
 
     def count(self):
-        if self._results_cache:
-            return self._results_cache.count
-        else:
-            return self[:0].raw()['hits']['total']
+        if self._results_cache is not None or self._future is not None:
+            return self._do_search().count
+        # The memoized body with no hits asked for, instead of compiling a
+        # sliced clone.
+        qs = dict(self._build_query(), size=0)
+        qs.pop('from', None)
+        return self._search(qs)['hits']['total']
 
     def __len__(self):
         return len(self._do_search())
@@ -77,12 +120,19 @@ class ES(object):
             return list(new)[0]
 
     def _build_query(self):
+        # ES instances don't change once they're built (every step returns a
+        # clone), so the compiled body can be reused by count(), raw(), etc.
+        if self._query_cache is None:
+            self._query_cache = self._compile_query()
+        return self._query_cache
+
+    def _compile_query(self):
         filters = []
         queries = []
         sort = []
         fields = ['id']
         facets = {}
-        as_list = as_dict = False
+        as_list = as_dict = as_object = False
         for action, value in self.steps:
             if action == 'order_by':
                 for key in value:
@@ -92,13 +142,15 @@ class ES(object):
                         sort.append(key)
             elif action == 'values':
                 fields.extend(value)
-                as_list, as_dict = True, False
-            elif action == 'values_dict':
+                as_list, as_dict, as_object = True, False, False
+            elif action in ('values_dict', 'values_object'):
                 if not value:
                     fields = []
                 else:
                     fields.extend(value)
-                as_list, as_dict = False, True
+                as_list = False
+                as_dict = action == 'values_dict'
+                as_object = action == 'values_object'
             elif action == 'query':
                 queries.extend(self._process_queries(value))
             elif action == 'filter':
@@ -108,9 +160,14 @@ class ES(object):
             else:
                 raise NotImplementedError(action)
 
+        # Put the clauses in a canonical order so logically identical searches
+        # produce identical JSON, which keeps ES's filter cache effective.
+        filters = _merge_filters(filters)
+        queries = _canonical(queries)
+
         qs = {}
         if len(filters) > 1:
-            qs['filter'] = {'and': filters}
+            qs['filter'] = {'and': {'filters': filters, '_cache': True}}
         elif filters:
             qs['filter'] = filters[0]
 
@@ -131,6 +188,7 @@ class ES(object):
             qs['size'] = self.stop - self.start
 
         self.fields, self.as_list, self.as_dict = fields, as_list, as_dict
+        self.as_object = as_object
         return qs
 
     def _split(self, string):
@@ -143,26 +201,28 @@ class ES(object):
         rv = []
         value = dict(value)
         or_ = value.pop('or_', [])
-        for key, val in value.items():
+        for key, val in sorted(value.items()):
             key, field_action = self._split(key)
             if field_action is None:
                 rv.append({'term': {key: val}})
             if field_action == 'in':
-                rv.append({'in': {key: val}})
+                # Sorted, so the order the values came in doesn't matter.
+                rv.append({'in': {key: sorted(val)}})
             elif field_action in ('gt', 'gte', 'lt', 'lte'):
                 rv.append({'range': {key: {field_action: val}}})
             elif field_action == 'range':
                 from_, to = val
                 rv.append({'range': {key: {'gte': from_, 'lte': to}}})
         if or_:
-            rv.append({'or': self._process_filters(or_.items())})
+            rv.append({'or': {'filters': _canonical(
+                self._process_filters(or_.items())), '_cache': True}})
         return rv
 
     def _process_queries(self, value):
         rv = []
         value = dict(value)
         or_ = value.pop('or_', [])
-        for key, val in value.items():
+        for key, val in sorted(value.items()):
             key, field_action = self._split(key)
             if field_action is None:
                 rv.append({'term': {key: val}})
@@ -175,32 +235,66 @@ class ES(object):
             elif field_action == 'fuzzy':
                 rv.append({'fuzzy': {key: val}})
         if or_:
-            rv.append({'bool': {'should': self._process_queries(or_.items())}})
+            rv.append({'bool': {'should': _canonical(
+                self._process_queries(or_.items()))}})
         return rv
 
     def _do_search(self):
-        if not self._results_cache:
-            hits = self.raw()
-            if self.as_dict:
-                ResultClass = DictSearchResults
-            elif self.as_list:
-                ResultClass = ListSearchResults
+        if self._results_cache is None:
+            if self._future is not None:
+                # Drop the future even if it failed, so the next access
+                # runs the search again instead of raising the same error.
+                future, self._future = self._future, None
+                hits = future.result()
             else:
-                ResultClass = ObjectSearchResults
-            self._results_cache = ResultClass(self.type, hits, self.fields)
+                hits = self.raw()
+            self._set_results(hits)
         return self._results_cache
 
+    def execute_async(self):
+        """
+        Start the search on a background thread and return a future.
+
+        The future resolves to the raw ES response.  Iterating over this
+        object afterwards waits on the future, so views can start all their
+        searches first and then use them as usual.  Only the ES round trip
+        happens off-thread; results are built (and objects are loaded from
+        the database) in the calling thread.
+        """
+        if self._results_cache is not None:
+            future = futures.Future()
+            future.set_result(self._results_cache.results)
+            return future
+        if self._future is None:
+            self._future = _get_executor().submit(self.raw)
+        return self._future
+
+    def _set_results(self, hits):
+        if self.as_dict:
+            ResultClass = DictSearchResults
+        elif self.as_object:
+            ResultClass = SourceSearchResults
+        elif self.as_list:
+            ResultClass = ListSearchResults
+        else:
+            ResultClass = ObjectSearchResults
+        self._results_cache = ResultClass(self.type, hits, self.fields)
+
     def raw(self):
-        qs = self._build_query()
-        es = elasticutils.get_es()
+        return self._search(self._build_query())
+
+    def _search(self, qs):
         try:
-            with statsd.timer('search.es.timer') as timer:
-                hits = es.search(qs, self.index, self.type._meta.db_table)
+            # Only time the request, not the wait for a pooled client.
+            with esclients.get_es() as es:
+                with statsd.timer('search.es.timer') as timer:
+                    hits = es.search(qs, self.index, self.type._meta.db_table)
         except Exception:
-            log.error(qs)
+            log.error('[%s] %s' % (query_shape(qs), qs))
             raise
         statsd.timing('search.es.took', hits['took'])
         log.debug('[%s] [%s] %s' % (hits['took'], timer.ms, qs))
+        _record_shape(self.type, qs, hits['took'], timer.ms)
         return hits
 
     def __iter__(self):
@@ -220,6 +314,162 @@ class ES(object):
         return facets
 
 
+def _json_default(obj):
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+    elif isinstance(obj, decimal.Decimal):
+        return float(obj)
+    elif isinstance(obj, (set, frozenset)):
+        # Sorted, so equal sets give the same JSON.
+        return sorted(obj)
+    elif isinstance(obj, Promise):
+        return force_unicode(obj)
+    raise TypeError(repr(obj))
+
+
+def _shape(node):
+    if isinstance(node, dict):
+        # Facets name the field they work on in a 'field' value.
+        items = ((k, v if k == 'field' else _shape(v))
+                 for k, v in sorted(node.items()) if k != '_cache')
+        return '{%s}' % ','.join('%s:%s' % kv for kv in items)
+    elif isinstance(node, list) and node and isinstance(node[0], dict):
+        return '[%s]' % ','.join(_shape(n) for n in node)
+    else:
+        return '?'
+
+
+def query_shape(qs):
+    """
+    Normalize a compiled query to its shape: the field names and operators
+    it uses, with all the values stripped out.
+    """
+    parts = []
+    for key, val in sorted(qs.items()):
+        if key in ('fields', 'sort'):
+            # These are made of field names, so keep them as they are.
+            val = json.dumps(val, sort_keys=True, default=_json_default)
+            parts.append('%s:%s' % (key, val))
+        elif key in ('from', 'size'):
+            parts.append(key)
+        else:
+            parts.append('%s:%s' % (key, _shape(val)))
+    return ' '.join(parts)
+
+
+def _record_shape(type_, qs, took, ms):
+    """
+    Send per-shape timings for a sample of the searches, and log any search
+    over ES_SLOW_QUERY_MS along with its shape.
+    """
+    rate = getattr(settings, 'ES_SHAPE_SAMPLE_RATE', 0.1)
+    threshold = getattr(settings, 'ES_SLOW_QUERY_MS', 1000)
+    slow = max(took, ms) >= threshold
+    sampled = random.random() < rate
+    if not (slow or sampled):
+        return
+
+    shape = query_shape(qs)
+    key = 'search.es.shape.%s.%s' % (type_._meta.db_table,
+                                     hashlib.md5(shape).hexdigest()[:12])
+    if sampled:
+        statsd.timing(key + '.took', took)
+        statsd.timing(key + '.timer', ms)
+    if slow:
+        statsd.incr(key + '.slow')
+        slow_log.warning('Slow search on %s: took=%sms network=%sms '
+                         'metric=%s shape=%s' % (type_._meta.db_table, took,
+                                                 ms, key, shape))
+
+
+def _clause_key(clause):
+    return json.dumps(clause, sort_keys=True, default=_json_default)
+
+
+def _canonical(clauses):
+    """Sort clauses into a stable order and drop exact duplicates."""
+    seen = {}
+    for clause in clauses:
+        seen.setdefault(_clause_key(clause), clause)
+    return [seen[key] for key in sorted(seen)]
+
+
+def _merge_filters(filters):
+    """
+    Canonicalize a list of filters that are ANDed together.
+
+    Besides dropping duplicates, several ``in`` filters on the same field are
+    merged into one filter on the intersection of their values.
+    """
+    rv, in_filters = [], {}
+    for f in filters:
+        if 'in' in f and len(f['in']) == 1:
+            field, values = f['in'].items()[0]
+            if field in in_filters:
+                in_filters[field] = [v for v in in_filters[field]
+                                     if v in values]
+            else:
+                in_filters[field] = list(values)
+        else:
+            rv.append(f)
+    rv.extend({'in': {field: sorted(values)}}
+              for field, values in in_filters.items())
+    return _canonical(rv)
+
+
+def multi_search(searches):
+    """
+    Run several ES searches in a single _msearch round trip.
+
+    Each search gets its results cache filled from the matching response, so
+    iterating over it afterwards doesn't go back to ES.  Searches that already
+    have results (or are already running) are skipped.  Returns the searches
+    that were passed in.
+
+    A search that ES reports an error for is logged and left without
+    results; the others are still filled in, and then the first error is
+    raised.
+    """
+    searches = list(searches)
+    pending = [s for s in searches
+               if s._results_cache is None and s._future is None]
+    if not pending:
+        return searches
+
+    lines, queries = [], []
+    for s in pending:
+        qs = s._build_query()
+        queries.append(qs)
+        lines.append(json.dumps({'index': s.index,
+                                 'type': s.type._meta.db_table}))
+        lines.append(json.dumps(qs, default=_json_default))
+    # The msearch body is newline delimited and has to end with a newline.
+    body = '\n'.join(lines) + '\n'
+
+    try:
+        with esclients.get_es() as es:
+            with statsd.timer('search.es.msearch.timer') as timer:
+                rv = es._send_request('GET', '/_msearch', body)
+    except Exception:
+        log.error(queries)
+        raise
+
+    statsd.incr('search.es.msearch.queries', len(pending))
+    errors = []
+    for s, qs, hits in zip(pending, queries, rv['responses']):
+        if 'error' in hits:
+            log.error('%s %s' % (hits['error'], qs))
+            errors.append(hits['error'])
+            continue
+        statsd.timing('search.es.took', hits['took'])
+        log.debug('[%s] [%s] %s' % (hits['took'], timer.ms, qs))
+        _record_shape(s.type, qs, hits['took'], timer.ms)
+        s._set_results(hits)
+    if errors:
+        raise pyes.exceptions.ElasticSearchException(errors[0])
+    return searches
+
+
 class SearchResults(object):
 
     def __init__(self, type, results, fields):
@@ -267,3 +517,75 @@ class ObjectSearchResults(SearchResults):
     def __iter__(self):
         objs = dict((obj.id, obj) for obj in self.objects)
         return (objs[id] for id in self.ids if id in objs)
+
+
+class SourceObject(object):
+    """
+    A read-only stand-in for a model instance, built from an ES document.
+
+    Attributes are the document's fields, which are named after the model
+    fields, so templates can use these in place of the real objects.  Only
+    what the model's ``extract()`` put in the document (or the fields asked
+    for in ``values_object()``) is there; anything else raises an
+    AttributeError naming the missing field.
+
+    Properties and methods listed in the model's ``source_properties`` are
+    borrowed from the model, so helpers like ``icon_url`` work too as long as
+    they only read fields that are in the document.
+    """
+
+    def __init__(self, type_, data):
+        self.__dict__.update(data)
+        self.__dict__['_type'] = type_
+
+    def __repr__(self):
+        return '<%s: %s %s>' % (self.__class__.__name__,
+                                self._type.__name__, self.__dict__.get('id'))
+
+    def __getattr__(self, attr):
+        # Only called for attributes that aren't in the document.
+        type_ = self.__dict__.get('_type')
+        if type_ is None or attr.startswith('__'):
+            raise AttributeError(attr)
+        if attr in getattr(type_, 'source_properties', ()):
+            for cls in type_.__mro__:
+                if attr in cls.__dict__:
+                    value = cls.__dict__[attr]
+                    if isinstance(value, property):
+                        return value.fget(self)
+                    return functools.partial(value, self)
+        raise AttributeError(
+            '%r has no %r: it has to be in the %s document (see extract() '
+            'and values_object()) or in source_properties.'
+            % (self, attr, type_._meta.db_table))
+
+    def __setattr__(self, attr, val):
+        raise AttributeError('%r is read-only.' % self)
+
+    @property
+    def pk(self):
+        return self.id
+
+
+class SourceSearchResults(SearchResults):
+
+    def set_objects(self, hits):
+        key = 'fields' if self.fields else '_source'
+        translated = [f.name for f in
+                      getattr(self.type._meta, 'translated_fields', [])]
+        lang = translation.get_language().lower()
+        objs = []
+        for hit in hits:
+            data = dict(hit[key])
+            data.setdefault('id', int(hit['_id']))
+            # Translated fields are stored as {locale: string}, pick the
+            # string for the current locale or fall back to the default.
+            fallback = (data.get('default_locale') or
+                        settings.LANGUAGE_CODE).lower()
+            for name in translated:
+                if hasattr(data.get(name), 'items'):
+                    strings = dict((k.lower(), v)
+                                   for k, v in data[name].items())
+                    data[name] = strings.get(lang, strings.get(fallback))
+            objs.append(SourceObject(self.type, data))
+        self.objects = objs
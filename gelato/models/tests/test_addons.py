@@ -0,0 +1,124 @@
+import datetime
+
+from django import test
+from django.core.cache import cache
+from django.db import connection
+
+from nose.tools import eq_
+
+from gelato.models.addons import (AddonBase, AddonCategoryBase,
+                                  AddonDependency, AddonUser, Category)
+from gelato.models.users import UserProfileBase
+from gelato.models.versions import VersionBase
+
+
+class TestAttachRelatedVersions(test.TestCase):
+
+    def setUp(self):
+        self.addon = AddonBase.objects.create(type=1)
+        self.old = VersionBase.objects.create(addon=self.addon, version='1.0')
+        self.new = VersionBase.objects.create(addon=self.addon, version='2.0')
+        # Different timestamps, newest first in the default ordering.
+        now = datetime.datetime.now()
+        VersionBase.objects.filter(pk=self.old.pk).update(
+            created=now - datetime.timedelta(days=1))
+        VersionBase.objects.filter(pk=self.new.pk).update(created=now)
+
+    def test_latest_is_highest_id(self):
+        AddonBase.attach_related_versions([self.addon])
+        eq_(self.addon._latest_version.id, self.new.id)
+
+    def test_latest_ignores_created(self):
+        VersionBase.objects.filter(pk=self.old.pk).update(
+            created=datetime.datetime.now() + datetime.timedelta(days=1))
+        AddonBase.attach_related_versions([self.addon])
+        eq_(self.addon._latest_version.id, self.new.id)
+
+    def test_versions_get_compatible_apps(self):
+        self.addon._current_version_id = self.old.id
+        AddonBase.attach_related_versions([self.addon])
+        eq_(self.addon._current_version.compatible_apps, {})
+        eq_(self.addon._latest_version.compatible_apps, {})
+
+    def test_no_versions(self):
+        addon = AddonBase.objects.create(type=1)
+        AddonBase.attach_related_versions([addon])
+        eq_(addon._latest_version, None)
+
+
+class TestPrefetchLoaders(test.TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addons = [AddonBase.objects.create(type=1, name='Addon %s' % i)
+                       for i in range(3)]
+        one, two, three = self.addons
+        fox, wolf = [UserProfileBase.objects.create(
+            username=name, email='%s@example.com' % name)
+            for name in ('fox', 'wolf')]
+        AddonUser.objects.create(addon=one, user=wolf, position=1)
+        AddonUser.objects.create(addon=one, user=fox, position=0)
+        AddonUser.objects.create(addon=two, user=wolf, listed=False)
+        self.cat = Category.objects.create(name='Tabs', type=1)
+        AddonCategoryBase.objects.create(addon=one, category=self.cat)
+        AddonDependency.objects.create(addon=one, dependent_addon=three)
+        self.fox, self.wolf = fox, wolf
+
+    def load(self, addons, *names):
+        """The add-ons loaded with ``names``, and the queries it took."""
+        cache.clear()
+        qs = AddonBase.objects.filter(pk__in=[a.pk for a in addons])
+        if names:
+            qs = qs.prefetch(*names)
+        debug, connection.use_debug_cursor = connection.use_debug_cursor, True
+        start = len(connection.queries)
+        try:
+            loaded = dict((a.pk, a) for a in qs)
+        finally:
+            connection.use_debug_cursor = debug
+        return loaded, len(connection.queries) - start
+
+    def extra_queries(self, name):
+        """The queries ``name`` adds for one add-on and for all of them."""
+        rv = []
+        for addons in (self.addons[:1], self.addons):
+            plain = self.load(addons)[1]
+            rv.append(self.load(addons, name)[1] - plain)
+        return rv
+
+    def test_authors(self):
+        addons = self.load(self.addons, 'authors')[0]
+        one, two, three = self.addons
+        eq_(addons[one.pk].listed_authors, [self.fox, self.wolf])
+        eq_(addons[two.pk].listed_authors, [])
+        eq_(self.extra_queries('authors'), [1, 1])
+
+    def test_categories(self):
+        addons = self.load(self.addons, 'categories')[0]
+        one, two, three = self.addons
+        eq_(addons[one.pk].all_categories, [self.cat])
+        eq_(addons[two.pk].all_categories, [])
+        one_addon, all_addons = self.extra_queries('categories')
+        eq_(one_addon, all_addons)
+
+    def test_dependencies(self):
+        addons = self.load(self.addons, 'dependencies')[0]
+        one, two, three = self.addons
+        eq_(addons[one.pk].all_dependencies, [three])
+        eq_(addons[two.pk].all_dependencies, [])
+        one_addon, all_addons = self.extra_queries('dependencies')
+        eq_(one_addon, all_addons)
+
+    def test_premium(self):
+        addons = self.load(self.addons, 'premium')[0]
+        eq_([a._premium for a in addons.values()], [None] * 3)
+        one_addon, all_addons = self.extra_queries('premium')
+        eq_(one_addon, all_addons)
+
+    def test_versions(self):
+        version = VersionBase.objects.create(addon=self.addons[0])
+        addons = self.load(self.addons, 'versions')[0]
+        eq_(addons[self.addons[0].pk]._latest_version, version)
+        eq_(addons[self.addons[1].pk]._latest_version, None)
+        one_addon, all_addons = self.extra_queries('versions')
+        eq_(one_addon, all_addons)
@@ -0,0 +1,531 @@
+import copy
+import cPickle as pickle
+
+from django import test
+from django.core.cache import cache
+from django.db import models, transaction
+
+from nose.tools import eq_, raises
+
+from gelato.models import base, cachestats, identity
+from gelato.models.addons import AddonBase
+from gelato.models.base import coalesce_updates, post_bulk_update
+from gelato.models.users import UserProfileBase
+
+
+def test_loading_isnt_dirty():
+    user = UserProfileBase(username='fox', email='fox@example.com')
+    eq_(user._dirty_attr, {})
+
+
+def test_assignment_is_tracked():
+    user = UserProfileBase(username='fox')
+    user.username = 'wolf'
+    user.username = 'bear'
+    eq_(user._dirty_attr, {'username': 'fox'})
+    eq_(user._changed_fields(), ['username'])
+
+
+def test_unpickle_without_tracking():
+    user = UserProfileBase(username='fox')
+    # Instances cached before assignments were tracked.
+    del user.__dict__['_dirty_attr'], user.__dict__['_trackers']
+    user = pickle.loads(pickle.dumps(user))
+    user.username = 'wolf'
+    eq_(user._dirty_attr, {'username': 'fox'})
+
+
+def test_copies_track_separately():
+    user = UserProfileBase(username='fox')
+    other = copy.copy(user)
+    other.username = 'wolf'
+    eq_(user._dirty_attr, {})
+    eq_(other._dirty_attr, {'username': 'fox'})
+
+
+class TestCoalesceUpdates(test.TestCase):
+
+    def setUp(self):
+        self.user = UserProfileBase.objects.create(username='fox',
+                                                   email='fox@example.com')
+        self.saves = []
+        models.signals.post_save.connect(self.saved, sender=UserProfileBase)
+
+    def tearDown(self):
+        models.signals.post_save.disconnect(self.saved,
+                                            sender=UserProfileBase)
+
+    def saved(self, sender, instance, **kw):
+        self.saves.append(instance.pk)
+
+    def fetch(self):
+        return UserProfileBase.objects.no_cache().get(pk=self.user.pk)
+
+    def test_one_update_per_row(self):
+        with coalesce_updates():
+            self.user.update(username='wolf')
+            self.user.update(location='den')
+            eq_(self.user.username, 'wolf')
+            eq_(self.fetch().username, 'fox')
+        user = self.fetch()
+        eq_((user.username, user.location), ('wolf', 'den'))
+        eq_(self.saves, [self.user.pk])
+
+    def test_signal_then_no_signal(self):
+        with coalesce_updates():
+            self.user.update(username='wolf')
+            self.user.update(location='den', _signal=False)
+        user = self.fetch()
+        eq_((user.username, user.location), ('wolf', 'den'))
+        eq_(self.saves, [self.user.pk])
+
+    def test_no_signal(self):
+        with coalesce_updates():
+            self.user.update(username='wolf', _signal=False)
+            self.user.update(location='den', _signal=False)
+        eq_(self.fetch().location, 'den')
+        eq_(self.saves, [])
+
+    def test_nothing_written_on_error(self):
+        try:
+            with coalesce_updates():
+                self.user.update(username='wolf')
+                raise ValueError
+        except ValueError:
+            pass
+        eq_(self.fetch().username, 'fox')
+
+
+def _mark(users):
+    for user in users:
+        user.marks = getattr(user, 'marks', 0) + 1
+
+
+class TestIdentityTransforms(test.TestCase):
+
+    def setUp(self):
+        self.user = UserProfileBase.objects.create(username='fox',
+                                                   email='fox@example.com')
+
+    def test_transform_runs_on_known_instance(self):
+        with identity.identity_map():
+            user = UserProfileBase.objects.get(pk=self.user.pk)
+            assert not hasattr(user, 'marks')
+            qs = UserProfileBase.objects.filter(pk=self.user.pk)
+            other, = qs.transform(_mark)
+            assert other is user
+            eq_(user.marks, 1)
+
+    def test_transform_runs_once(self):
+        with identity.identity_map():
+            qs = UserProfileBase.objects.filter(pk=self.user.pk)
+            user, = qs.transform(_mark)
+            list(qs.no_cache().transform(_mark))
+            eq_(user.marks, 1)
+
+    def test_live_instances_stay_out_of_the_cache(self):
+        qs = UserProfileBase.objects.filter(username='fox')
+        with identity.identity_map():
+            user = UserProfileBase.objects.get(pk=self.user.pk)
+            user.location = 'den'
+            other, = qs
+            assert other is user
+        # The cached copy is the row, not the changed instance.
+        cached, = qs
+        assert cached is not user
+        eq_(cached.location, '')
+
+    def test_extra_select_keeps_its_own_objects(self):
+        with identity.identity_map():
+            user = UserProfileBase.objects.get(pk=self.user.pk)
+            other, = (UserProfileBase.objects.filter(pk=self.user.pk)
+                      .extra(select={'seven': 7}))
+            assert other is not user
+            eq_(other.seven, 7)
+
+    def test_annotate_keeps_its_own_objects(self):
+        with identity.identity_map():
+            user = UserProfileBase.objects.get(pk=self.user.pk)
+            other, = (UserProfileBase.objects.filter(pk=self.user.pk)
+                      .annotate(ids=models.Count('id')))
+            assert other is not user
+            eq_(other.ids, 1)
+
+    def test_uncached_querysets_dont_share(self):
+        with identity.identity_map():
+            user = UserProfileBase.objects.get(pk=self.user.pk)
+            other, = UserProfileBase.uncached.filter(pk=self.user.pk)
+            assert other is not user
+
+
+def _lower_username(sender, instance, **kw):
+    instance.username = instance.username.lower()
+
+
+class TestUpdate(test.TestCase):
+
+    def setUp(self):
+        self.user = UserProfileBase.objects.create(username='fox',
+                                                   email='fox@example.com')
+        models.signals.pre_save.connect(_lower_username,
+                                        sender=UserProfileBase)
+
+    def tearDown(self):
+        models.signals.pre_save.disconnect(_lower_username,
+                                           sender=UserProfileBase)
+
+    def fetch(self):
+        return UserProfileBase.objects.no_cache().get(pk=self.user.pk)
+
+    def test_pre_save_rewrites_assigned_field(self):
+        self.user.update(username='WOLF')
+        eq_(self.user.username, 'wolf')
+        eq_(self.fetch().username, 'wolf')
+
+    def test_pre_save_changes_other_field(self):
+        self.user.update(username='Wolf', location='den')
+        user = self.fetch()
+        eq_((user.username, user.location), ('wolf', 'den'))
+
+    def test_translations_not_changed_after_update(self):
+        self.user.update(bio='Quick and brown.')
+        assert '_changed_translations' not in self.user.__dict__
+        eq_(self.user._changed_fields(), [])
+
+
+class TestSaveDirtyOnly(test.TestCase):
+
+    def setUp(self):
+        UserProfileBase.save_dirty_only = True
+
+    def tearDown(self):
+        UserProfileBase.save_dirty_only = False
+
+    def test_explicit_pk_is_inserted(self):
+        seen = []
+
+        def saved(sender, instance, created=None, **kw):
+            seen.append(created)
+
+        models.signals.post_save.connect(saved, sender=UserProfileBase)
+        try:
+            UserProfileBase(pk=999, username='fox',
+                            email='fox@example.com').save()
+        finally:
+            models.signals.post_save.disconnect(saved,
+                                                sender=UserProfileBase)
+        eq_(UserProfileBase.objects.no_cache().get(pk=999).username, 'fox')
+        eq_(seen, [True])
+
+    def test_loaded_instance_updates_changes(self):
+        UserProfileBase.objects.create(pk=999, username='fox',
+                                       email='fox@example.com')
+        user = UserProfileBase.objects.no_cache().get(pk=999)
+        user.location = 'den'
+        user.save()
+        eq_(UserProfileBase.objects.no_cache().get(pk=999).location, 'den')
+
+
+class TestNegativeCache(test.TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = UserProfileBase.objects.create(username='fox',
+                                                   email='fox@example.com')
+
+    def tearDown(self):
+        cache.clear()
+
+    def get(self, username):
+        return UserProfileBase.objects.get(username=username)
+
+    def sneak_in(self, username):
+        # bulk_create() doesn't send post_save, so the miss isn't forgotten.
+        UserProfileBase.objects.bulk_create([
+            UserProfileBase(username=username, email='%s@e.com' % username)])
+
+    def test_hit(self):
+        eq_(self.get('fox').pk, self.user.pk)
+
+    def test_miss_is_cached(self):
+        with self.assertRaises(UserProfileBase.DoesNotExist):
+            self.get('wolf')
+        self.sneak_in('wolf')
+        label = 'users.userprofilebase', 'negative_hit'
+        hits = cachestats.counts[label]
+        with self.assertRaises(UserProfileBase.DoesNotExist):
+            self.get('wolf')
+        eq_(cachestats.counts[label], hits + 1)
+
+    def test_save_forgets_miss(self):
+        with self.assertRaises(UserProfileBase.DoesNotExist):
+            self.get('wolf')
+        UserProfileBase.objects.create(username='wolf',
+                                       email='wolf@example.com')
+        eq_(self.get('wolf').username, 'wolf')
+
+    def test_update_forgets_miss(self):
+        with self.assertRaises(UserProfileBase.DoesNotExist):
+            self.get('wolf')
+        self.user.update(username='wolf')
+        eq_(self.get('wolf').pk, self.user.pk)
+
+    def test_queryset_update_forgets_miss(self):
+        with self.assertRaises(UserProfileBase.DoesNotExist):
+            self.get('wolf')
+        UserProfileBase.objects.filter(pk=self.user.pk).update(
+            username='wolf')
+        eq_(self.get('wolf').pk, self.user.pk)
+
+    def test_miss_in_transaction_isnt_cached(self):
+        with transaction.commit_on_success():
+            with self.assertRaises(UserProfileBase.DoesNotExist):
+                self.get('wolf')
+        self.sneak_in('wolf')
+        eq_(self.get('wolf').username, 'wolf')
+
+    def test_replica_miss_checked_on_master(self):
+        self.sneak_in('wolf')
+        qs = UserProfileBase.objects.all()
+        # The row is on the master, so a replica that missed it is behind.
+        assert not qs._missing_on_master('replica', (), {'username': 'wolf'})
+        assert qs._missing_on_master('replica', (), {'username': 'bear'})
+
+
+class TestBulkUpdate(test.TestCase):
+
+    def setUp(self):
+        self.users = [UserProfileBase.objects.create(
+            username='user%s' % i, email='user%s@example.com' % i)
+            for i in range(3)]
+        self.sent = []
+        post_bulk_update.connect(self.bulk_updated, sender=UserProfileBase)
+
+    def tearDown(self):
+        post_bulk_update.disconnect(self.bulk_updated,
+                                    sender=UserProfileBase)
+
+    def bulk_updated(self, sender, instances, fields, **kw):
+        self.sent.append(([obj.pk for obj in instances], fields))
+
+    def fetch(self, user):
+        return UserProfileBase.objects.no_cache().get(pk=user.pk)
+
+    def test_rows_get_their_own_values(self):
+        one, two, three = self.users
+        with self.assertNumQueries(1):
+            count = UserProfileBase.objects.bulk_update(
+                [(one, {'location': 'den'}), (two, {'location': "o'hare"})])
+        eq_(count, 2)
+        eq_(self.fetch(one).location, 'den')
+        eq_(self.fetch(two).location, "o'hare")
+        eq_(self.fetch(three).location, '')
+        eq_(one.location, 'den')
+
+    def test_grouped_by_fields(self):
+        one, two, three = self.users
+        with self.assertNumQueries(2):
+            count = UserProfileBase.objects.bulk_update(
+                [(one, {'location': 'den'}),
+                 (two, {'location': 'burrow', 'username': 'badger'}),
+                 (three, {})])
+        eq_(count, 2)
+        two = self.fetch(two)
+        eq_((two.location, two.username), ('burrow', 'badger'))
+
+    def test_chunks(self):
+        with self.assertNumQueries(2):
+            count = UserProfileBase.objects.bulk_update(
+                [(u, {'location': 'den'}) for u in self.users], chunk_size=2)
+        eq_(count, 3)
+        eq_([self.fetch(u).location for u in self.users], ['den'] * 3)
+
+    def test_db_column(self):
+        addons = [AddonBase.objects.create(type=1) for i in range(2)]
+        AddonBase.objects.bulk_update([(addons[0], {'type': 2}),
+                                       (addons[1], {'type': 3})])
+        eq_([AddonBase.objects.no_cache().get(pk=a.pk).type for a in addons],
+            [2, 3])
+
+    def test_cache_invalidated(self):
+        qs = UserProfileBase.objects.filter(pk=self.users[0].pk)
+        eq_(qs[0].location, '')
+        UserProfileBase.objects.bulk_update(
+            [(self.users[0], {'location': 'den'})])
+        eq_(UserProfileBase.objects.filter(pk=self.users[0].pk)[0].location,
+            'den')
+
+    def test_not_dirty_after(self):
+        user = self.users[0]
+        user.location = 'cave'
+        UserProfileBase.objects.bulk_update([(user, {'location': 'den'})])
+        eq_(user._dirty_attr, {})
+
+    def test_signal(self):
+        one, two, three = self.users
+        UserProfileBase.objects.bulk_update(
+            [(one, {'location': 'den'}), (two, {'location': 'den'})],
+            chunk_size=1, signal=True)
+        eq_(self.sent, [([one.pk], ['location']), ([two.pk], ['location'])])
+
+    def test_no_signal(self):
+        UserProfileBase.objects.bulk_update(
+            [(self.users[0], {'location': 'den'})])
+        eq_(self.sent, [])
+
+
+class TestUpdateNotify(test.TestCase):
+
+    def setUp(self):
+        self.users = [UserProfileBase.objects.create(
+            username='user%s' % i, email='user%s@example.com' % i)
+            for i in range(3)]
+        self.users[2].update(location='den')
+        self.callbacks = list(base._on_change_callbacks.get(UserProfileBase,
+                                                            []))
+        self.heard, self.queued = [], []
+        self._queue_changes = base.indexing.queue_changes
+        base.indexing.queue_changes = (
+            lambda cls, changes: self.queued.append(changes))
+
+    def tearDown(self):
+        base._on_change_callbacks[UserProfileBase] = self.callbacks
+        base.indexing.queue_changes = self._queue_changes
+
+    def qs(self):
+        return UserProfileBase.objects.filter(
+            pk__in=[u.pk for u in self.users])
+
+    def watch_batch(self, changes, sender, **kw):
+        self.heard.append(sorted(changes))
+
+    def watch_each(self, old_attr, new_attr, instance, sender, **kw):
+        self.heard.append((instance.pk, old_attr['location'],
+                           new_attr['location']))
+
+    def test_without_callbacks(self):
+        with self.assertNumQueries(1):
+            eq_(self.qs().update_notify(location='den'), 3)
+
+    def test_batch_callback(self):
+        UserProfileBase.on_change(self.watch_batch, fields=['location'],
+                                  batch=True)
+        one, two, three = self.users
+        # One query for the old values, one for the UPDATE.
+        with self.assertNumQueries(2):
+            eq_(self.qs().update_notify(location='den'), 3)
+        # The third row already had the value, so it didn't change.
+        eq_(self.heard, [[(one.pk, {'location': ''}, {'location': 'den'}),
+                          (two.pk, {'location': ''}, {'location': 'den'})]])
+        eq_(self.queued, [{one.pk: {'location': 'den'},
+                           two.pk: {'location': 'den'}}])
+        eq_(UserProfileBase.objects.no_cache().get(pk=one.pk).location,
+            'den')
+
+    def test_instance_callback(self):
+        UserProfileBase.on_change(self.watch_each, fields=['location'])
+        one, two, three = self.users
+        with self.assertNumQueries(2):
+            self.qs().update_notify(location='den')
+        eq_(sorted(self.heard), [(one.pk, '', 'den'), (two.pk, '', 'den')])
+
+    def test_both_kinds(self):
+        UserProfileBase.on_change(self.watch_batch, fields=['location'],
+                                  batch=True)
+        UserProfileBase.on_change(self.watch_each, fields=['location'])
+        self.qs().filter(pk=self.users[0].pk).update_notify(location='den')
+        pk = self.users[0].pk
+        eq_(self.heard, [[(pk, {'location': ''}, {'location': 'den'})],
+                         (pk, '', 'den')])
+
+    def test_other_fields_arent_heard(self):
+        UserProfileBase.on_change(self.watch_batch, fields=['location'],
+                                  batch=True)
+        with self.assertNumQueries(1):
+            self.qs().update_notify(username=models.F('email'))
+        eq_(self.heard, [])
+
+    def test_f_expressions(self):
+        UserProfileBase.on_change(self.watch_batch, fields=['location'],
+                                  batch=True)
+        # The new values are read back after the UPDATE.
+        with self.assertNumQueries(3):
+            self.qs().update_notify(location=models.F('username'))
+        eq_(len(self.heard[0]), 3)
+        eq_(self.heard[0][0][2], {'location': self.users[0].username})
+
+
+loaded = []
+
+
+def _load_nicknames(users):
+    loaded.append([u.pk for u in users])
+    for user in users:
+        user.nickname = user.username.title()
+
+
+def _load_proxy_nicknames(users):
+    for user in users:
+        user.nickname = 'proxy'
+
+UserProfileBase.register_prefetch('nickname', _load_nicknames,
+                                  attr='nickname')
+
+
+class ProxyUser(UserProfileBase):
+
+    class Meta:
+        proxy = True
+        app_label = 'users'
+
+
+class OtherProxyUser(UserProfileBase):
+
+    class Meta:
+        proxy = True
+        app_label = 'users'
+
+OtherProxyUser.register_prefetch('nickname', _load_proxy_nicknames)
+
+
+class TestPrefetch(test.TestCase):
+
+    def setUp(self):
+        del loaded[:]
+        self.users = [UserProfileBase.objects.create(
+            username='user%s' % i, email='user%s@example.com' % i)
+            for i in range(3)]
+        self.pks = [u.pk for u in self.users]
+
+    def test_once_per_batch(self):
+        users = list(UserProfileBase.objects.no_cache()
+                     .filter(pk__in=self.pks).prefetch('nickname'))
+        eq_(sorted(u.nickname for u in users), ['User0', 'User1', 'User2'])
+        eq_([sorted(pks) for pks in loaded], [sorted(self.pks)])
+
+    def test_named_twice(self):
+        list(UserProfileBase.objects.no_cache().filter(pk__in=self.pks)
+             .prefetch('nickname', 'nickname'))
+        eq_(len(loaded), 1)
+
+    def test_skips_objects_with_attr(self):
+        one, two, three = self.users
+        one.nickname = 'mine'
+        base._prefetcher(UserProfileBase, 'nickname')([one, two])
+        eq_(loaded, [[two.pk]])
+        eq_(one.nickname, 'mine')
+
+    def test_inherited(self):
+        users = list(ProxyUser.objects.no_cache().filter(pk__in=self.pks)
+                     .prefetch('nickname'))
+        eq_(sorted(u.nickname for u in users), ['User0', 'User1', 'User2'])
+
+    def test_overridden(self):
+        users = list(OtherProxyUser.objects.no_cache()
+                     .filter(pk__in=self.pks).prefetch('nickname'))
+        eq_([u.nickname for u in users], ['proxy'] * 3)
+        eq_(loaded, [])
+
+    @raises(ValueError)
+    def test_unknown(self):
+        UserProfileBase.objects.prefetch('nope')
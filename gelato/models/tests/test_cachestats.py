@@ -0,0 +1,74 @@
+import time
+
+from django.test.utils import override_settings
+
+from nose.tools import eq_
+
+from gelato.models import cachepolicy, cachestats
+
+
+class _Meta(object):
+    app_label, module_name = 'tests', 'fake'
+
+
+class _Query(object):
+    compiled = 0
+
+    def sql_with_params(self):
+        self.compiled += 1
+        return 'SELECT fake', ()
+
+
+class _QuerySet(object):
+    model = type('Fake', (object,), {'_meta': _Meta})
+    timeout = None
+    query = _Query()
+
+
+def _slow(n):
+    for i in range(n):
+        time.sleep(.01)
+        yield i
+
+
+class TestObserve(object):
+
+    def setUp(self):
+        self.settings = override_settings(CACHE_STATS_SHAPE_SAMPLE_RATE=1)
+        self.settings.enable()
+        self.recorded = []
+        self._record_shape = cachestats.record_shape
+        cachestats.record_shape = lambda sql, ms: self.recorded.append(ms)
+        cachestats.counts.clear()
+
+    def tearDown(self):
+        cachestats.record_shape = self._record_shape
+        self.settings.disable()
+
+    def observe(self, objs):
+        return cachestats.observe(_QuerySet(), objs, cachepolicy.READ_THROUGH)
+
+    def test_counts_whole_queryset(self):
+        eq_(list(self.observe(_slow(2))), [0, 1])
+        eq_(cachestats.counts['tests.fake', 'miss'], 1)
+        eq_(len(self.recorded), 1)
+
+    def test_counts_partial_queryset(self):
+        objs = self.observe(_slow(3))
+        next(objs)
+        objs.close()
+        eq_(cachestats.counts['tests.fake', 'miss'], 1)
+
+    def test_times_only_the_fetch(self):
+        for obj in self.observe(_slow(2)):
+            time.sleep(.1)
+        ms, = self.recorded
+        assert 20 <= ms < 100, ms
+
+    def test_shapes_are_sampled(self):
+        qs = _QuerySet()
+        qs.query = _Query()
+        with override_settings(CACHE_STATS_SHAPE_SAMPLE_RATE=0):
+            list(cachestats.observe(qs, _slow(1), cachepolicy.BYPASS))
+        eq_(cachestats.counts['tests.fake', 'bypass'], 1)
+        eq_((self.recorded, qs.query.compiled), ([], 0))
@@ -0,0 +1,115 @@
+from django.test.utils import override_settings
+
+from nose.tools import eq_, raises
+
+from gelato.models import esclients
+from gelato.models.esclients import ClientPool
+
+
+class FakeES(object):
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self.queued = []
+        self.flushed = []
+
+    def index(self, doc, *args, **kw):
+        self.queued.append(doc)
+
+    def flush_bulk(self, forced=False):
+        self.flushed.extend(self.queued)
+        self.queued = []
+
+
+def pool(**kw):
+    config = dict(size=2, keepalive=60, timeout=5, factory=FakeES)
+    config.update(kw)
+    return ClientPool('test', **config)
+
+
+def test_reuse():
+    p = pool()
+    with p.client() as es:
+        pass
+    with p.client() as again:
+        assert again is es
+    eq_((p.stats['created'], p.stats['reused']), (1, 1))
+    eq_(es.timeout, 5)
+
+
+def test_concurrent_checkouts_get_their_own():
+    p = pool()
+    with p.client() as one:
+        with p.client() as two:
+            assert one is not two
+            eq_(p.health()['in_use'], 2)
+    eq_(p.health()['idle'], 2)
+
+
+def test_expired_clients_are_flushed_and_dropped():
+    p = pool(keepalive=0)
+    with p.client() as es:
+        es.index({'id': 1})
+    with p.client() as other:
+        assert other is not es
+    eq_(es.flushed, [{'id': 1}])
+    eq_(p.stats['expired'], 1)
+
+
+@raises(ValueError)
+def test_errors_discard_the_client():
+    p = pool()
+    try:
+        with p.client() as es:
+            es.index({'id': 1})
+            raise ValueError
+    finally:
+        eq_(es.flushed, [{'id': 1}])
+        eq_(p.health()['idle'], 0)
+        eq_(p.health()['in_use'], 0)
+
+
+class TestPools(object):
+
+    def setup(self):
+        self.pools = dict(esclients._pools)
+        esclients._pools.clear()
+
+    def teardown(self):
+        esclients._pools.clear()
+        esclients._pools.update(self.pools)
+
+    @override_settings(ES_CLIENT_FACTORY=__name__ + '.FakeES')
+    def test_pools_are_separate(self):
+        with esclients.get_es('search') as search:
+            with esclients.get_es('bulk') as bulk:
+                assert search is not bulk
+        eq_(esclients.get_pool('bulk').size, 1)
+        assert esclients.get_pool('search') is not esclients.get_pool('bulk')
+
+    @override_settings(ES_CLIENT_FACTORY=__name__ + '.FakeES', ES_TIMEOUT=9,
+                       ES_POOLS={'index': {'timeout': 60}})
+    def test_es_timeout(self):
+        with esclients.get_es('search') as es:
+            eq_(es.timeout, 9)
+        with esclients.get_es('index') as es:
+            eq_(es.timeout, 60)
+
+    @override_settings(ES_CLIENT_FACTORY=__name__ + '.FakeES')
+    def test_flush_bulk(self):
+        with esclients.get_es('bulk') as es:
+            es.index({'id': 1})
+        esclients.flush_bulk()
+        eq_(es.flushed, [{'id': 1}])
+
+    @override_settings(ES_CLIENT_FACTORY=__name__ + '.FakeES')
+    def test_flushed_when_request_finishes(self):
+        from django.core import signals
+        with esclients.get_es('bulk') as es:
+            es.index({'id': 1})
+        signals.request_finished.send(sender=None)
+        eq_(es.flushed, [{'id': 1}])
+
+    def test_flush_without_pool(self):
+        esclients.flush_bulk()
+        assert 'bulk' not in esclients._pools
@@ -0,0 +1,153 @@
+from django import test
+from django.db import connection, models, transaction
+
+from nose.tools import eq_
+
+from gelato.models import indexing
+
+
+class _Meta(object):
+
+    def get_field(self, name):
+        raise models.FieldDoesNotExist(name)
+
+
+class Indexed(object):
+    """Records what would have been sent to ES."""
+    index_on_change = True
+    partial_index_fields = {'status': 'status'}
+    _meta = _Meta()
+    partial = full = None
+
+    @classmethod
+    def reset(cls):
+        cls.partial, cls.full = {}, []
+
+    @classmethod
+    def partial_index(cls, docs):
+        cls.partial.update(docs)
+        return []
+
+    @classmethod
+    def index_ids(cls, ids):
+        # Indexing reads the rows, which used to break the end of the
+        # transaction block.
+        connection.cursor().execute('SELECT 1')
+        cls.full.extend(ids)
+
+
+class _Field(object):
+
+    def __init__(self, name, auto_now=False):
+        self.attname = name
+        self.auto_now = auto_now
+
+
+class _DatedMeta(_Meta):
+
+    def get_field(self, name):
+        if name == 'modified':
+            return _Field(name, auto_now=True)
+        return super(_DatedMeta, self).get_field(name)
+
+
+class Dated(Indexed):
+    """Has an auto_now field that isn't in the document."""
+    _meta = _DatedMeta()
+
+
+class Broken(Indexed):
+    """Fails every partial update, and full indexing of pk 13."""
+
+    @classmethod
+    def partial_index(cls, docs):
+        raise ValueError
+
+    @classmethod
+    def index_ids(cls, ids):
+        if 13 in ids:
+            raise ValueError
+        cls.full.extend(ids)
+
+
+class TestIndexingQueue(test.TransactionTestCase):
+
+    def setUp(self):
+        Indexed.reset()
+        Broken.reset()
+        Dated.reset()
+
+    def queue(self, pk, changes=None):
+        indexing.queue_changes(Indexed, {pk: changes or {'name': 'x'}})
+
+    def test_autocommit(self):
+        self.queue(1)
+        eq_(Indexed.full, [1])
+
+    def test_partial(self):
+        self.queue(1, {'status': 4})
+        eq_(Indexed.partial, {1: {'status': 4}})
+        eq_(Indexed.full, [])
+
+    def test_batch(self):
+        with indexing.batch():
+            self.queue(1)
+            self.queue(1, {'status': 4})
+            eq_(Indexed.full, [])
+        # The full rebuild covers the partial update.
+        eq_(Indexed.full, [1])
+        eq_(Indexed.partial, {})
+
+    def test_commit(self):
+        with transaction.commit_on_success():
+            self.queue(1)
+            transaction.set_dirty()
+        eq_(Indexed.full, [1])
+
+    def test_commit_waits_for_outer_block(self):
+        with transaction.commit_on_success():
+            with transaction.commit_on_success():
+                self.queue(1)
+                transaction.set_dirty()
+            eq_(Indexed.full, [])
+        eq_(Indexed.full, [1])
+
+    def test_rollback(self):
+        try:
+            with transaction.commit_on_success():
+                self.queue(1)
+                transaction.set_dirty()
+                raise ValueError
+        except ValueError:
+            pass
+        eq_(Indexed.full, [])
+        with transaction.commit_on_success():
+            self.queue(2)
+            transaction.set_dirty()
+        eq_(Indexed.full, [2])
+
+    def test_rollback_other_database(self):
+        with transaction.commit_manually():
+            self.queue(1)
+            indexing.rolled_back('other')
+            transaction.commit()
+        eq_(Indexed.full, [1])
+
+    def test_partial_failure_indexes_in_full(self):
+        indexing.queue_changes(Broken, {1: {'status': 4}})
+        eq_(Broken.full, [1])
+
+    def test_failure_keeps_other_models(self):
+        with indexing.batch():
+            indexing.queue_changes(Broken, {13: {'name': 'x'}})
+            self.queue(1)
+        eq_(Indexed.full, [1])
+
+    def test_auto_now_left_out(self):
+        indexing.queue_changes(Dated, {1: {'status': 4, 'modified': 'now'}})
+        eq_(Dated.partial, {1: {'status': 4}})
+        eq_(Dated.full, [])
+
+    def test_only_auto_now(self):
+        indexing.queue_changes(Dated, {1: {'modified': 'now'}})
+        eq_((Dated.partial, Dated.full), ({}, []))
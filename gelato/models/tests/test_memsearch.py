@@ -0,0 +1,127 @@
+import json
+
+from nose.tools import eq_, raises
+
+import pyes.exceptions
+
+from gelato.models import memsearch
+from gelato.models.memsearch import MemoryES, match_filter, match_query
+
+
+DOCS = [
+    {'id': 1, 'name': 'Fox Tabs', 'status': 4, 'app': [1, 9],
+     'created': '2012-01-01'},
+    {'id': 2, 'name': 'Adblock', 'status': 4, 'app': [1],
+     'created': '2012-02-01'},
+    {'id': 3, 'name': 'Tab Mix', 'status': 1, 'app': [9],
+     'created': '2012-03-01'},
+]
+
+
+def setup():
+    global es
+    es = MemoryES(store={})
+    for doc in DOCS:
+        es.index(doc, 'default', 'addons', id=doc['id'])
+
+
+def ids(rv):
+    return [int(h['_id']) for h in rv['hits']['hits']]
+
+
+def test_store_is_shared():
+    memsearch.reset()
+    MemoryES().index({'id': 1}, 'default', 'addons', id=1)
+    eq_(MemoryES().get('default', 'addons', 1)['_source'], {'id': 1})
+    memsearch.reset()
+
+
+def test_get():
+    eq_(es.get('default', 'addons', 2)['_source']['name'], 'Adblock')
+
+
+@raises(pyes.exceptions.NotFoundException)
+def test_delete():
+    es.index({'id': 4}, 'default', 'addons', id=4)
+    es.delete('default', 'addons', 4)
+    es.get('default', 'addons', 4)
+
+
+@raises(pyes.exceptions.ElasticSearchException)
+def test_force_insert():
+    es.index({'id': 1}, 'default', 'addons', id=1, force_insert=True)
+
+
+def test_match_filter():
+    doc = DOCS[0]
+    assert match_filter({'term': {'status': 4}}, doc)
+    assert match_filter({'in': {'app': [9, 10]}}, doc)
+    assert not match_filter({'in': {'app': [2]}}, doc)
+    assert match_filter({'range': {'created': {'gte': '2012-01-01'}}}, doc)
+    assert match_filter({'and': {'filters': [{'term': {'status': 4}},
+                                             {'term': {'app': 1}}]}}, doc)
+    assert match_filter({'or': [{'term': {'status': 1}},
+                                {'term': {'app': 9}}]}, doc)
+    assert not match_filter({'not': {'filter': {'term': {'status': 4}}}},
+                            doc)
+
+
+def test_match_query():
+    doc = DOCS[0]
+    eq_(match_query({'text': {'name': 'fox tabs'}}, doc), 2)
+    eq_(match_query({'prefix': {'name': 'fo'}}, doc), 1)
+    eq_(match_query({'fuzzy': {'name': 'tobs'}}, doc), 1)
+    eq_(match_query({'text': {'name': 'adblock'}}, doc), 0)
+
+
+def test_search_filter_and_sort():
+    rv = es.search({'filter': {'term': {'app': 1}},
+                    'sort': [{'id': 'desc'}]}, 'default', 'addons')
+    eq_(ids(rv), [2, 1])
+    eq_(rv['hits']['total'], 2)
+
+
+def test_search_fields_and_paging():
+    rv = es.search({'sort': ['id'], 'fields': ['id', 'name'], 'from': 1,
+                    'size': 1}, 'default', 'addons')
+    eq_(rv['hits']['total'], 3)
+    eq_(rv['hits']['hits'][0]['fields'], {'id': 2, 'name': 'Adblock'})
+
+
+def test_search_doc_type():
+    eq_(es.search({}, 'default', 'users')['hits']['total'], 0)
+
+
+def test_facets_ignore_filter():
+    rv = es.search({'filter': {'term': {'status': 1}},
+                    'facets': {'status': {'terms': {'field': 'status'}}}},
+                   'default', 'addons')
+    eq_(ids(rv), [3])
+    eq_(rv['facets']['status']['terms'],
+        [{'term': 4, 'count': 2}, {'term': 1, 'count': 1}])
+
+
+def test_msearch():
+    header = {'index': 'default', 'type': 'addons'}
+    lines = [header, {'filter': {'term': {'id': 1}}},
+             header, {'query': {'nope': {}}}]
+    body = '\n'.join(json.dumps(l) for l in lines) + '\n'
+    one, two = es._send_request('GET', '/_msearch', body)['responses']
+    eq_(ids(one), [1])
+    assert 'error' in two
+
+
+def test_update():
+    es.index(dict(DOCS[1]), 'default', 'addons', id=2)
+    es._send_request('POST', '/default/addons/2/_update',
+                     {'script': 'ctx._source.status = p0',
+                      'params': {'p0': 5}})
+    eq_(es.get('default', 'addons', 2)['_source']['status'], 5)
+    es.index(dict(DOCS[1]), 'default', 'addons', id=2)
+
+
+@raises(pyes.exceptions.ElasticSearchException)
+def test_update_missing():
+    es._send_request('POST', '/default/addons/99/_update',
+                     {'script': 'ctx._source.status = p0',
+                      'params': {'p0': 5}})
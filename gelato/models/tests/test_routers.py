@@ -0,0 +1,114 @@
+from django import test
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, models
+from django.http import HttpResponse
+from django.test.client import RequestFactory
+
+from nose.tools import eq_
+
+from gelato.models import routers
+from gelato.models.users import UserProfileBase
+
+
+class TestPinning(test.TestCase):
+
+    def setUp(self):
+        routers.unpin()
+        self.router = routers.ReplicaRouter()
+
+    def tearDown(self):
+        routers.unpin()
+
+    def test_db_for_write_doesnt_pin(self):
+        eq_(self.router.db_for_write(UserProfileBase), DEFAULT_DB_ALIAS)
+        assert not routers.is_pinned()
+
+    def test_unrouted_models(self):
+        eq_(self.router.db_for_write(models.Model), None)
+        eq_(self.router.db_for_read(models.Model), None)
+
+    def test_save_pins(self):
+        UserProfileBase.objects.create(username='fox', email='fox@a.com')
+        assert routers.is_pinned()
+
+    def test_delete_pins(self):
+        user = UserProfileBase.objects.create(username='fox',
+                                              email='fox@a.com')
+        routers.unpin()
+        user.delete()
+        assert routers.is_pinned()
+
+    def test_queryset_update_pins(self):
+        UserProfileBase.objects.filter(pk=0).update(location='den')
+        assert routers.is_pinned()
+
+    def test_bulk_update_pins(self):
+        user = UserProfileBase.objects.create(username='fox',
+                                              email='fox@a.com')
+        routers.unpin()
+        UserProfileBase.objects.bulk_update([(user, {'location': 'den'})])
+        assert routers.is_pinned()
+
+    def test_pinned_reads_go_to_master(self):
+        routers.pin()
+        eq_(self.router.db_for_read(UserProfileBase), DEFAULT_DB_ALIAS)
+
+
+class TestReadCounts(test.TestCase):
+
+    def setUp(self):
+        cache.clear()
+        routers.counts.clear()
+        UserProfileBase.objects.create(username='fox', email='fox@a.com')
+
+    def reads(self):
+        return sum(routers.counts.values())
+
+    def test_routing_isnt_a_read(self):
+        routers.ReplicaRouter().db_for_read(UserProfileBase)
+        eq_(self.reads(), 0)
+
+    def test_query_is_counted(self):
+        qs = UserProfileBase.objects.no_cache().no_transforms()
+        list(qs.filter(username='fox'))
+        eq_(self.reads(), 1)
+
+    def test_cache_hits_arent_counted(self):
+        qs = UserProfileBase.objects.filter(username='fox')
+        list(qs)
+        reads = self.reads()
+        list(UserProfileBase.objects.filter(username='fox'))
+        eq_(self.reads(), reads)
+
+
+class TestPinningMiddleware(test.TestCase):
+
+    def setUp(self):
+        self.middleware = routers.PinningMiddleware()
+        self.factory = RequestFactory()
+
+    def tearDown(self):
+        routers.unpin()
+
+    def test_get_isnt_pinned(self):
+        self.middleware.process_request(self.factory.get('/'))
+        assert not routers.is_pinned()
+
+    def test_post_is_pinned(self):
+        self.middleware.process_request(self.factory.post('/'))
+        assert routers.is_pinned()
+
+    def test_cookie_pins(self):
+        request = self.factory.get('/')
+        request.COOKIES[routers.PIN_COOKIE] = 'y'
+        self.middleware.process_request(request)
+        assert routers.is_pinned()
+
+    def test_cookie_set_after_write(self):
+        request = self.factory.get('/')
+        self.middleware.process_request(request)
+        response = self.middleware.process_response(request, HttpResponse())
+        assert routers.PIN_COOKIE not in response.cookies
+        routers.wrote()
+        response = self.middleware.process_response(request, HttpResponse())
+        assert routers.PIN_COOKIE in response.cookies
@@ -0,0 +1,230 @@
+import datetime
+import decimal
+
+from django.test.utils import override_settings
+from django.utils.translation import ugettext_lazy as _lazy
+
+from nose.tools import eq_, raises
+
+import pyes.exceptions
+
+from gelato.models import esclients, memsearch
+from gelato.models.search import (ES, SourceObject, _canonical, _clause_key,
+                                  _merge_filters, multi_search)
+
+
+def test_clause_key_sorts_keys():
+    eq_(_clause_key({'term': {'a': 1, 'b': 2}}),
+        _clause_key({'term': {'b': 2, 'a': 1}}))
+
+
+def test_clause_key_values():
+    # None of these are JSON types, but they show up in filters.
+    _clause_key({'in': {'status': set([1, 2])}})
+    _clause_key({'range': {'price': {'gte': decimal.Decimal('1.5')}}})
+    _clause_key({'range': {'created': {'gte': datetime.datetime.now()}}})
+    _clause_key({'term': {'name': _lazy(u'Firefox')}})
+
+
+def test_clause_key_sets():
+    eq_(_clause_key({'in': {'status': set([2, 1])}}),
+        _clause_key({'in': {'status': [1, 2]}}))
+
+
+def test_canonical():
+    a, b = {'term': {'a': 1}}, {'term': {'b': 1}}
+    eq_(_canonical([b, a, b]), [a, b])
+    eq_(_canonical([a, b]), _canonical([b, a]))
+
+
+def test_merge_filters_intersection():
+    filters = [{'in': {'status': [1, 2, 3]}}, {'term': {'type': 1}},
+               {'in': {'status': set([2, 3, 4])}}, {'in': {'app': [1]}}]
+    eq_(_merge_filters(filters),
+        _canonical([{'in': {'status': [2, 3]}}, {'in': {'app': [1]}},
+                    {'term': {'type': 1}}]))
+
+
+def test_merge_filters_duplicates():
+    f = {'term': {'type': 1}}
+    eq_(_merge_filters([f, dict(f)]), [f])
+
+
+def test_same_query_in_any_order():
+    s = ES(None, 'default')
+    one = s.filter(type=1, status__in=[1, 2]).query(name__text='fox')
+    two = s.query(name__text='fox').filter(status__in=[1, 2]).filter(type=1)
+    eq_(one._build_query(), two._build_query())
+
+
+def test_in_values_in_any_order():
+    s = ES(None, 'default')
+    one = s.filter(status__in=[4, 1, 2]).filter(type__in=set([3, 1]))
+    two = s.filter(type__in=[1, 3]).filter(status__in=[2, 4, 1])
+    eq_(one._build_query(), two._build_query())
+    eq_(one._build_query()['filter']['and']['filters'],
+        [{'in': {'status': [1, 2, 4]}}, {'in': {'type': [1, 3]}}])
+
+
+def test_merge_filters_sorts_values():
+    eq_(_merge_filters([{'in': {'status': [3, 1, 2]}},
+                        {'in': {'status': [2, 3]}}]),
+        [{'in': {'status': [2, 3]}}])
+
+
+class _Meta(object):
+    db_table = 'addons'
+
+
+class _Addon(object):
+    _meta = _Meta
+    source_properties = ('icon_url', 'name_upper')
+
+    @property
+    def icon_url(self):
+        return '/img/%s.png' % self.id
+
+    def name_upper(self):
+        return self.name.upper()
+
+    @property
+    def not_allowed(self):
+        return 1
+
+
+def test_source_object():
+    obj = SourceObject(_Addon, {'id': 3, 'name': u'fox'})
+    eq_(obj.pk, 3)
+    eq_(obj.icon_url, '/img/3.png')
+    eq_(obj.name_upper(), u'FOX')
+
+
+@raises(AttributeError)
+def test_source_object_missing_field():
+    SourceObject(_Addon, {'id': 3}).summary
+
+
+@raises(AttributeError)
+def test_source_object_unlisted_property():
+    SourceObject(_Addon, {'id': 3}).not_allowed
+
+
+@raises(AttributeError)
+def test_source_object_read_only():
+    SourceObject(_Addon, {'id': 3}).name = u'fox'
+
+
+DOCS = [{'id': 1, 'name': u'fox', 'status': 4},
+        {'id': 2, 'name': u'wolf', 'status': 4},
+        {'id': 3, 'name': u'bear', 'status': 1}]
+
+
+class TestRunningSearches(object):
+
+    def setup(self):
+        self.settings = override_settings(
+            ES_CLIENT_FACTORY='gelato.models.memsearch.MemoryES')
+        self.settings.enable()
+        self.pools = dict(esclients._pools)
+        esclients._pools.clear()
+        memsearch.reset()
+        es = memsearch.MemoryES()
+        for doc in DOCS:
+            es.index(doc, 'default', 'addons', id=doc['id'])
+        self.s = ES(_Addon, 'default').values_dict('id', 'name')
+
+    def teardown(self):
+        memsearch.reset()
+        esclients._pools.clear()
+        esclients._pools.update(self.pools)
+        self.settings.disable()
+
+    def names(self, s):
+        return [r['name'] for r in s]
+
+    def broken(self):
+        # The in-memory ES doesn't do histograms, so this one fails.
+        return self.s.facet(h={'histogram': {'field': 'status'}})
+
+    def test_count(self):
+        eq_(self.s.filter(status=4).count(), 2)
+        # The total doesn't depend on the page.
+        eq_(self.s.filter(status=4)[1:].count(), 2)
+
+    def test_count_reuses_body(self):
+        s = self.s.filter(status=4)
+        body = s._build_query()
+        eq_(s.count(), 2)
+        assert s._build_query() is body
+        assert 'size' not in body
+
+    def test_multi_search(self):
+        searches = [self.s.filter(status=4).order_by('id'),
+                    self.s.filter(status=1), self.s.order_by('-id')]
+        eq_(multi_search(searches), searches)
+        for s in searches:
+            assert s._results_cache is not None
+        eq_([self.names(s) for s in searches],
+            [[u'fox', u'wolf'], [u'bear'], [u'bear', u'wolf', u'fox']])
+
+    def test_multi_search_skips_done(self):
+        done = self.s.filter(status=1)
+        list(done)
+        results = done._results_cache
+        multi_search([done, self.s.filter(status=4)])
+        assert done._results_cache is results
+
+    def test_multi_search_error(self):
+        one, bad, two = (self.s.filter(status=4), self.broken(),
+                         self.s.filter(status=1))
+        try:
+            multi_search([one, bad, two])
+        except pyes.exceptions.ElasticSearchException, e:
+            assert 'histogram' in unicode(e)
+        else:
+            assert False, 'The error should have been raised.'
+        # The good ones are filled in anyway.
+        eq_(self.names(two), [u'bear'])
+        eq_(len(one._results_cache), 2)
+        eq_(bad._results_cache, None)
+
+    def test_execute_async(self):
+        s = self.s.filter(status=1)
+        future = s.execute_async()
+        eq_(future.result()['hits']['total'], 1)
+        assert s.execute_async() is future
+        eq_(self.names(s), [u'bear'])
+        eq_(s._future, None)
+
+    def test_execute_async_after_results(self):
+        s = self.s.filter(status=1)
+        list(s)
+        eq_(s.execute_async().result(), s._results_cache.results)
+
+    def test_execute_async_count(self):
+        s = self.s.filter(status=4)
+        s.execute_async()
+        eq_(s.count(), 2)
+
+    @raises(NotImplementedError)
+    def test_execute_async_error(self):
+        s = self.broken()
+        s.execute_async()
+        list(s)
+
+    def test_execute_async_error_not_kept(self):
+        s = self.broken()
+        s.execute_async()
+        try:
+            list(s)
+        except NotImplementedError:
+            pass
+        # The failed future is dropped, so the search runs again.
+        eq_(s._future, None)
+
+    def test_multi_search_skips_running(self):
+        s = self.s.filter(status=1)
+        future = s.execute_async()
+        multi_search([s])
+        assert s._future is future
+        eq_(self.names(s), [u'bear'])
@@ -0,0 +1,132 @@
+from django import test
+from django.core.cache import cache
+from django.db import connection
+from django.utils import translation
+
+from nose.tools import eq_
+
+from gelato.models.addons import AddonBase, Category
+from gelato.models.transforms import cached_transform
+from gelato.models.users import UserProfileBase
+from gelato.translations.models import Translation
+
+
+calls = []
+
+
+@cached_transform(attr='shout', name='tests.shout', per_locale=True)
+def shout(users):
+    calls.extend(u.pk for u in users)
+    for user in users:
+        user.shout = '%s:%s' % (user.username.upper(),
+                                translation.get_language())
+
+shout.invalidate_on(UserProfileBase, lambda user: [user.pk])
+
+
+@cached_transform(attr='label', name='tests.label')
+def label(cats):
+    calls.extend(c.pk for c in cats)
+    for cat in cats:
+        cat.label = unicode(cat.name)
+
+label.invalidate_on(Category, translated=['name'])
+
+
+class ProxyUser(UserProfileBase):
+
+    class Meta:
+        proxy = True
+        app_label = 'users'
+
+
+class TestCachedTransform(test.TestCase):
+
+    def setUp(self):
+        cache.clear()
+        del calls[:]
+        self.user = UserProfileBase.objects.create(username='fox',
+                                                   email='fox@example.com')
+
+    def tearDown(self):
+        translation.deactivate()
+
+    def run_on(self):
+        user = UserProfileBase.uncached.get(pk=self.user.pk)
+        shout([user])
+        return user
+
+    def test_cached(self):
+        expected = 'FOX:%s' % translation.get_language()
+        eq_(self.run_on().shout, expected)
+        eq_(self.run_on().shout, expected)
+        eq_(calls, [self.user.pk])
+
+    def test_per_locale(self):
+        self.run_on()
+        translation.activate('de')
+        eq_(self.run_on().shout, 'FOX:de')
+        eq_(calls, [self.user.pk] * 2)
+
+    def test_invalidate_pks(self):
+        self.run_on()
+        shout.invalidate([self.user.pk])
+        self.run_on()
+        eq_(calls, [self.user.pk] * 2)
+
+    def test_generation(self):
+        self.run_on()
+        shout.invalidate()
+        self.run_on()
+        eq_(calls, [self.user.pk] * 2)
+
+    def test_invalidated_on_save(self):
+        self.run_on()
+        self.user.save()
+        self.run_on()
+        eq_(calls, [self.user.pk] * 2)
+
+    def test_invalidated_by_subclass(self):
+        self.run_on()
+        ProxyUser.objects.get(pk=self.user.pk).save()
+        self.run_on()
+        eq_(calls, [self.user.pk] * 2)
+
+
+class TestTranslationInvalidation(test.TestCase):
+
+    def setUp(self):
+        cache.clear()
+        del calls[:]
+        self.cat = Category.objects.create(name='Fox', type=1)
+
+    def label(self):
+        cat = Category.objects.get(pk=self.cat.pk)
+        label([cat])
+        return cat.label
+
+    def test_translation_save(self):
+        eq_(self.label(), 'Fox')
+        trans = Translation.objects.get(id=self.cat.name_id)
+        trans.localized_string = 'Wolf'
+        trans.save()
+        eq_(self.label(), 'Wolf')
+        eq_(calls, [self.cat.pk] * 2)
+
+    def test_other_owners_dont_query(self):
+        addon = AddonBase.objects.create(type=1, name='Badger')
+        # Loading it remembers who owns the translation.
+        AddonBase.objects.get(pk=addon.pk)
+        self.label()
+        trans = Translation.objects.get(id=addon.name_id)
+        trans.localized_string = 'Honey Badger'
+        debug, connection.use_debug_cursor = connection.use_debug_cursor, True
+        start = len(connection.queries)
+        try:
+            trans.save()
+        finally:
+            connection.use_debug_cursor = debug
+        assert not [q for q in connection.queries[start:]
+                    if 'categories' in q['sql']]
+        self.label()
+        eq_(calls, [self.cat.pk])
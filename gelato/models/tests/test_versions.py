@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import CommandError
+
+from nose.tools import eq_, raises
+
+from gelato.models.management.commands import backfill_version_int
+from gelato.models.versions import version_int, version_ints
+
+
+def test_version_ints_match_version_int():
+    cases = ['*', '1.*', '3.6a1pre2', None, '', '1.2|3', u'1.0é', u'٣.0',
+             '1.0', '3.6.28', '4.0b10', '1.2.3.4', '10.0a2pre', '1.0pre1']
+    eq_(version_ints(cases), [version_int(c) for c in cases])
+
+
+def test_version_ints_empty():
+    eq_(version_ints([]), [])
+
+
+@raises(CommandError)
+def test_backfill_after_needs_model():
+    backfill_version_int.Command().handle(after=5, model=None,
+                                          chunk_size=1000)
@@ -0,0 +1,177 @@
+"""
+Transforms whose results are cached per object.
+
+A transform that sets one attribute on each object can be cached with::
+
+    @cached_transform(attr='all_categories', per_locale=True)
+    def transformer(addons):
+        ...
+
+    transformer.invalidate_on(AddonCategory, lambda ac: [ac.addon_id])
+    transformer.invalidate_on(Category, translated=['name'])
+
+Each object's value is cached under its pk (and the locale, if the value has
+translations in it), and the wrapped function only runs on the objects
+missing from the cache.  ``invalidate_on(model, getter)`` forgets the pks
+returned by ``getter(instance)`` when a ``model`` instance is saved or
+deleted, or sent in ``post_bulk_update``.  Without a getter any change to
+``model`` forgets everything, by starting a new generation of keys.
+
+``QuerySet.update()`` and ``update_notify()`` don't send those signals, so
+code that changes the rows a transform reads that way has to call
+``transformer.invalidate()`` itself.
+
+Cached transforms run on objects coming out of the queryset cache (see
+``after_cache`` in :mod:`gelato.models.base`), so they don't stop the rows
+from being shared across locales.
+"""
+import functools
+import operator
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import models
+from django.db.models import Q
+from django.utils import translation
+
+from gelato.models.base import post_bulk_update
+
+
+# Generations have to outlive the entries they cover.
+GENERATION_TIMEOUT = 60 * 60 * 24 * 30
+
+
+def _generation(name):
+    key = 'tx-gen:%s' % name
+    gen = cache.get(key)
+    if gen is None:
+        # Start after any generation that was evicted, not back at 0.
+        cache.add(key, '%x' % int(time.time() * 1000), GENERATION_TIMEOUT)
+        gen = cache.get(key)
+    return gen
+
+
+def _bump(name):
+    cache.set('tx-gen:%s' % name, '%x' % int(time.time() * 1000),
+              GENERATION_TIMEOUT)
+
+
+def _tables(model):
+    """The tables of ``model`` and its subclasses."""
+    return set(m._meta.db_table for m in models.get_models()
+               if issubclass(m, model))
+
+
+def cached_transform(attr, name=None, per_locale=False, timeout=None):
+    """
+    Cache the ``attr`` that the decorated transform sets on each object.
+
+    ``name`` defaults to the transform's module and name.  Set
+    ``per_locale`` if the values depend on the current locale.
+    """
+    def decorator(fn):
+        tx_name = name or '%s.%s' % (fn.__module__, fn.__name__)
+        tx_timeout = (timeout if timeout is not None else
+                      getattr(settings, 'TRANSFORM_CACHE_TIMEOUT', 60 * 60))
+
+        def key(gen, pk, lang):
+            return 'tx:%s:%s:%s:%s' % (tx_name, gen, pk, lang)
+
+        @functools.wraps(fn)
+        def wrapper(objs):
+            if not objs:
+                return
+            gen = _generation(tx_name)
+            lang = translation.get_language().lower() if per_locale else ''
+            keys = dict((key(gen, obj.pk, lang), obj) for obj in objs)
+            cached = cache.get_many(keys.keys())
+            missing = []
+            for k, obj in keys.items():
+                if k in cached:
+                    setattr(obj, attr, cached[k])
+                else:
+                    missing.append(obj)
+            if not missing:
+                return
+            fn(missing)
+            cache.set_many(dict((key(gen, obj.pk, lang), getattr(obj, attr))
+                                for obj in missing if hasattr(obj, attr)),
+                           tx_timeout)
+
+        def invalidate(pks=None):
+            """Forget the values for ``pks``, or all of them."""
+            if pks is None:
+                _bump(tx_name)
+                return
+            gen = _generation(tx_name)
+            all_langs = ([l.lower() for l in dict(settings.LANGUAGES)]
+                         if per_locale else [''])
+            cache.delete_many([key(gen, pk, l) for pk in pks
+                               for l in all_langs])
+
+        def invalidate_on(model, getter=None, translated=()):
+            """
+            Invalidate when a ``model`` instance, or an instance of one of its
+            subclasses, is saved or deleted.  ``translated`` names the
+            model's translated fields the transform uses, which change
+            without the instance being saved.  Translations that are known
+            to belong to other models are skipped without a query.
+            """
+            def forget(instances):
+                if getter is None:
+                    invalidate()
+                else:
+                    invalidate([pk for obj in instances for pk in getter(obj)])
+
+            def receiver(sender, instance, **kw):
+                if issubclass(sender, model):
+                    forget([instance])
+
+            def bulk_receiver(sender, instances, **kw):
+                if issubclass(sender, model):
+                    forget(instances)
+
+            def translation_receiver(sender, instance, **kw):
+                from gelato.translations import transformer
+                if (not issubclass(sender, Translation) or
+                        getattr(instance, '_saved_with', None) is not None):
+                    # Saved by its owner, whose own save is heard above.
+                    return
+                owner = cache.get(transformer._owner_key(instance.id))
+                if owner is not None and owner[0] not in _tables(model):
+                    return
+                manager = getattr(model, 'uncached', model._default_manager)
+                owners = manager.filter(reduce(operator.or_, [
+                    Q(**{model._meta.get_field(name).attname: instance.id})
+                    for name in translated]))
+                if getter is None:
+                    if owners.exists():
+                        invalidate()
+                else:
+                    forget(owners)
+
+            uid = 'tx:%s:%s' % (tx_name, model._meta.db_table)
+            # Without a sender, so subclasses of ``model`` count too.
+            models.signals.post_save.connect(receiver, weak=False,
+                                             dispatch_uid=uid)
+            models.signals.post_delete.connect(receiver, weak=False,
+                                               dispatch_uid=uid)
+            post_bulk_update.connect(bulk_receiver, weak=False,
+                                     dispatch_uid=uid)
+            if translated:
+                from gelato.translations.models import Translation
+                # Without a sender, for the Purified and Linkified ones too.
+                models.signals.post_save.connect(
+                    translation_receiver, weak=False,
+                    dispatch_uid=uid + ':translations')
+                models.signals.post_delete.connect(
+                    translation_receiver, weak=False,
+                    dispatch_uid=uid + ':translations')
+
+        wrapper.after_cache = True
+        wrapper.transform_key = 'tx:%s' % tx_name
+        wrapper.invalidate = invalidate
+        wrapper.invalidate_on = invalidate_on
+        return wrapper
+    return decorator
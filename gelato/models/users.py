@@ -31,6 +31,9 @@ def get_hexdigest(algorithm, salt, raw_password):
 
 
 class UserProfileBase(OnChangeMixin, ModelBase):
+    # Logins and forms look users up by email, often ones that don't exist.
+    negative_cache_fields = ('email', 'username')
+
     username = models.CharField(max_length=255, default='', unique=True)
     display_name = models.CharField(max_length=255, default='', null=True,
                                     blank=True)
@@ -145,6 +145,32 @@ def version_dict(version):
     return d
 
 
+def version_ints(versions):
+    """
+    version_int() for a lot of version strings at once.
+
+    This skips the intermediate dicts and smart_str() calls, which is most of
+    the time version_int() spends on each string.
+    """
+    match = version_re.match
+    atrans = {'a': 0, 'b': 1}
+    fmt = "%d%02d%02d%02d%d%02d%d%02d"
+    rv = []
+    for version in versions:
+        m = match(version or '')
+        if m is None:
+            groups = (None,) * 8
+        else:
+            groups = m.groups()
+        major, minor1, minor2, minor3, alpha, alpha_ver, pre, pre_ver = [
+            99 if g == '*' else g for g in groups]
+        v = fmt % (int(major or 0), int(minor1 or 0), int(minor2 or 0),
+                   int(minor3 or 0), atrans.get(alpha, 2),
+                   int(alpha_ver or 0), 0 if pre else 1, int(pre_ver or 0))
+        rv.append(min(int(v), MAXVERSION))
+    return rv
+
+
 def version_int(version):
     d = version_dict(smart_str(version))
     for key in ['alpha_ver', 'major', 'minor1', 'minor2', 'minor3',
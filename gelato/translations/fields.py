@@ -90,7 +90,12 @@ def save_on_signal(obj, trans):
     def cb(sender, instance, **kw):
         if instance is obj:
             is_new = trans.autoid is None
-            trans.save(force_insert=is_new, force_update=not is_new)
+            # Lets receivers know the owner's own signals are coming.
+            trans._saved_with = obj
+            try:
+                trans.save(force_insert=is_new, force_update=not is_new)
+            finally:
+                del trans._saved_with
             signal.disconnect(cb)
     signal.connect(cb, sender=obj.__class__, weak=False)
 
@@ -119,6 +124,11 @@ class TranslationDescriptor(related.ReverseSingleRelatedObjectDescriptor):
 
     def __set__(self, instance, value):
         lang = translation_utils.get_language()
+        if isinstance(value, (basestring, dict)):
+            # Strings can be saved into an existing Translation without
+            # changing the foreign key, so note the change for OnChangeMixin.
+            instance.__dict__.setdefault('_changed_translations',
+                                         set()).add(self.field.name)
         if isinstance(value, basestring):
             value = self.translation_from_string(instance, lang, value)
         elif hasattr(value, 'items'):
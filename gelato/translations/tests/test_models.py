@@ -8,6 +8,7 @@ import jinja2
 from nose.tools import eq_
 from test_utils import ExtraAppTestCase, trans_eq
 
+from gelato.models.cachepolicy import BYPASS, REFRESH, cache_policy
 from testapp.models import TranslatedModel, UntranslatedModel, FancyModel
 from translations.models import (Translation, PurifiedTranslation,
                                  TranslationSequence)
@@ -336,6 +337,27 @@ class TranslationTestCase(ExtraAppTestCase):
         eq_(unicode(obj.no_locale), 'blammo')
         eq_(obj.no_locale.locale, 'fr')
 
+    def test_translation_save_flushes_cache(self):
+        obj = TranslatedModel.objects.get(id=1)
+        trans_eq(obj.name, 'some name', 'en-US')
+        obj.name.localized_string = 'new name'
+        obj.name.save()
+        obj = TranslatedModel.objects.get(id=1)
+        trans_eq(obj.name, 'new name', 'en-US')
+
+    def test_translation_cache_policy(self):
+        obj = TranslatedModel.objects.get(id=1)
+        # An update() doesn't send signals, so the cache isn't flushed.
+        Translation.objects.filter(id=obj.name_id, locale='en-US').update(
+            localized_string='changed')
+        with cache_policy(BYPASS):
+            trans_eq(TranslatedModel.objects.get(id=1).name, 'changed',
+                     'en-US')
+        with cache_policy(REFRESH):
+            trans_eq(TranslatedModel.objects.get(id=1).name, 'changed',
+                     'en-US')
+        trans_eq(TranslatedModel.objects.get(id=1).name, 'changed', 'en-US')
+
 
 def test_translation_bool():
     t = lambda s: Translation(localized_string=s)
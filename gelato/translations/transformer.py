@@ -1,9 +1,9 @@
 from django.conf import settings
-from django.db import connections, models
+from django.core.cache import cache
+from django.db import connections, models, router
 from django.utils import translation
 
-import multidb
-
+from gelato.models import cachepolicy, routers
 from gelato.translations.models import Translation
 from gelato.translations.fields import TranslatedField
 
@@ -63,17 +63,55 @@ def build_query(model, connection):
     return s, params
 
 
+def _cache_key(table, pk, lang):
+    return 'trans:%s:%s:%s' % (table, pk, lang.lower())
+
+
+def _owner_key(translation_id):
+    # Which object's cached translations a Translation row is part of.
+    return 'trans-of:%s' % translation_id
+
+
 def get_trans(items):
+    """
+    Attach the translations in the current locale to ``items``.
+
+    They're cached per object and locale, so only objects that haven't been
+    seen in this locale lately cost a query.  The cache policy in effect is
+    followed: REFRESH queries and caches again, BYPASS doesn't touch the
+    cache.
+    """
     if not items:
         return
 
-    connection = connections[multidb.get_slave()]
+    model = items[0].__class__
+    lang = translation.get_language()
+    policy = cachepolicy.get_policy()
+    if policy == cachepolicy.READ_THROUGH:
+        keys = dict((_cache_key(model._meta.db_table, item.pk, lang), item)
+                    for item in items)
+        cached = cache.get_many(keys.keys())
+        missing = []
+        for key, item in keys.items():
+            if key in cached:
+                for name, t in cached[key].items():
+                    setattr(item, name, t)
+            else:
+                missing.append(item)
+        if not missing:
+            return
+    else:
+        missing = list(items)
+
+    alias = router.db_for_read(model)
+    routers.read(model, alias)
+    connection = connections[alias]
     cursor = connection.cursor()
 
-    model = items[0].__class__
     sql, params = build_query(model, connection)
-    item_dict = dict((item.pk, item) for item in items)
+    item_dict = dict((item.pk, item) for item in missing)
     ids = ','.join(map(str, item_dict.keys()))
+    found = dict((pk, {}) for pk in item_dict)
 
     cursor.execute(sql.format(ids='(%s)' % ids), tuple(params))
     step = len(trans_fields)
@@ -85,3 +123,45 @@ def get_trans(items):
             t = Translation(*row[start:start+step])
             if t.id is not None and t.localized_string is not None:
                 setattr(item, field.name, t)
+                found[item.pk][field.name] = t
+
+    if policy == cachepolicy.BYPASS:
+        return
+    timeout = getattr(settings, 'TRANSLATION_CACHE_TIMEOUT', 60 * 5)
+    entries = dict((_cache_key(model._meta.db_table, pk, lang), trans)
+                   for pk, trans in found.items())
+    # Remember the owners of the Translation rows, so saving one of them
+    # can forget the object's cached translations.
+    for item in missing:
+        for field in model._meta.translated_fields:
+            translation_id = item.__dict__.get(field.attname)
+            if translation_id is not None:
+                entries[_owner_key(translation_id)] = (model._meta.db_table,
+                                                       item.pk)
+    cache.set_many(entries, timeout)
+
+# Translations depend on the locale, so attach them to objects coming out of
+# the cache instead of caching a copy of every object per locale.
+get_trans.after_cache = True
+# It reads and writes the cache as the caller's cache policy says.
+get_trans.follows_cache_policy = True
+
+
+def _forget(table, pk):
+    cache.delete_many([_cache_key(table, pk, lang)
+                       for lang in dict(settings.LANGUAGES)])
+
+
+def _flush(sender, instance, **kw):
+    """Forget the cached translations of a saved or deleted object."""
+    if issubclass(sender, Translation):
+        owner = cache.get(_owner_key(instance.id))
+        if owner is not None:
+            _forget(*owner)
+        return
+    if not hasattr(sender._meta, 'translated_fields') or instance.pk is None:
+        return
+    _forget(sender._meta.db_table, instance.pk)
+
+models.signals.post_save.connect(_flush, dispatch_uid='transformer.flush')
+models.signals.post_delete.connect(_flush, dispatch_uid='transformer.flush')